@@ -1,7 +1,15 @@
 import copy
+import functools
+import hashlib
+import itertools
+import multiprocessing
 import os
+import queue
 import random
+import shutil
 import sys
+import threading
+import time
 from typing import List, Dict, Any
 
 import numpy as np
@@ -10,8 +18,8 @@ import torch
 import torch.nn as nn
 from PIL import Image
 import cv2
-from sklearn.metrics import cohen_kappa_score, precision_score, recall_score, accuracy_score
-from torch.utils.data import Dataset, DataLoader
+from sklearn.utils.class_weight import compute_class_weight
+from torch.utils.data import Dataset, DataLoader, RandomSampler, Sampler, WeightedRandomSampler
 from torchvision import models, transforms
 from torchvision.transforms.functional import to_pil_image
 from tqdm import tqdm
@@ -40,6 +48,92 @@ CONFIG = {
         'clahe': True,
         'gaussian_blur': True,
         'sharpen': True
+    },
+    'preprocessing_options': {
+        'fused': True,  # Run the enabled steps with FusedPreprocessor instead of the per-step PIL chain
+        # Downscale to this size before enhancing, with blur sigma and kernel sizes scaled to match.
+        # None enhances at native resolution. See benchmark_preprocessing.py --enhance-sizes.
+        'enhance_size': None
+    },
+    'preprocessing_cache': {
+        'enabled': True,
+        'cache_dir': './cache/preprocessed',
+        'working_size': 512  # Side length of the cached images, None keeps native resolution
+    },
+    'materialized_preprocessing': {
+        'enabled': False,
+        'materialized_dir': './materialized'  # Output directory of materialize_preprocessing.py
+    },
+    'packed_dataset': {
+        'enabled': False,
+        'packed_dir': './packed'  # Output directory of pack_dataset.py
+    },
+    'data_loader': {
+        'num_workers': min(8, os.cpu_count() or 1),  # 0 loads every batch in the main process
+        'persistent_workers': True,  # Keep workers alive between epochs instead of re-forking them
+        'prefetch_factor': 2,  # Batches loaded in advance by each worker
+        'reproducible': True,  # Draw shuffling and worker seeds from a fixed-seed generator
+        'seed': 42,
+        'oversampling': False,  # Draw training samples class-balanced with DynamicOversampler
+        'device_prefetch': 2,  # Batches train_model copies to the device ahead of time, 0 disables it
+        'cpu_threads': None,  # Cores ThreadBudget splits between training and workers, None uses all available
+        # Workers return uint8 images (collate_uint8) and NormalizeBatch converts them once per batch
+        # on the device, a quarter of the float32 bytes pass through shared memory
+        'uint8_batches': False,
+        'memory_report': False  # Print RSS and private memory of the training process and workers every epoch
+    },
+    'decoding': {
+        # Decode JPEGs at the smallest DCT scale (1/2, 1/4, 1/8) still covering this size,
+        # None decodes at full resolution. Only used when no preprocessing step is enabled, the
+        # preprocessing steps decode at their own size (preprocessing_options.enhance_size).
+        'decode_size': 256
+    },
+    'roi_crop': {
+        # Crop every image to the bounding box of the retina before preprocessing and resizing.
+        # Boxes are detected once per split and kept in <split>_roi.npz next to its CSV.
+        'enabled': False,
+        'threshold': 10,  # Pixels brighter than this in any channel count as retina
+        'detect_size': 256  # Resolution the boxes are detected at
+    },
+    'image_cache': {
+        'enabled': True,
+        'max_bytes': 1024 ** 3,  # Budget per dataset, least recently used images are evicted beyond it
+        # Images decoded up front to size the cache slots. Larger images are counted and not cached.
+        'size_probes': 8
+    },
+    'augmentation': {
+        # Emit resized uint8 tensors from the loader and run the transform_train augmentations
+        # on whole batches with BatchAugmentation instead of per image in the workers
+        'batched': False,
+        # Otherwise apply brightness and gamma as one lookup table on uint8 images and scale
+        # and normalize whole batches on the device (transform_train_lut + NormalizeBatch)
+        'lut_color': True,
+        # Run Resize, RandomCrop, SLORandomPad, FundRandomRotate and the flips as a single
+        # warpAffine (SingleWarpAugmentation) instead of one resampling per step
+        'single_warp': True
+    },
+    'training': {
+        # Steps between host reads of the on-device running loss for the progress bar. Loss and
+        # confusion matrix otherwise stay on the device until the end of the epoch.
+        'sync_interval': 50
+    },
+    'checkpoints': {
+        # Epoch checkpoints kept on disk, written on a background thread. The checkpoint path
+        # itself always holds the best epoch by validation kappa.
+        'keep_last': 1,
+        'keep_best': 1,
+        # Continue an interrupted run from <checkpoint stem>_resume.pth, written at the end of
+        # every epoch and every resume_interval training steps (0 for epoch ends only)
+        'resume': True,
+        'resume_interval': 200
+    },
+    'amp': {
+        # Autocast forward passes in training and evaluation. bfloat16 works on CPU and CUDA,
+        # float16 needs CUDA and adds GradScaler loss scaling. Losses and metrics stay float32.
+        'enabled': False,
+        'dtype': 'bfloat16',
+        # Throughput and kappa of every run, one row per run and precision
+        'report_path': './reports/precision_comparison.csv'
     }
 }
 
@@ -49,6 +143,62 @@ num_classes = 5
 learning_rate = 0.0001
 num_epochs = 25
 
+def decode_image(img_path, size=None, box=None):
+    """Decode an image, letting the JPEG decoder downscale in the DCT domain.
+
+    With `size` set, PIL's draft mode picks the smallest 1/2, 1/4 or 1/8 scale whose output
+    is still at least `size` x `size`, so most pixels of a full-resolution fundus photo are
+    never decoded. `box` (left, top, right, bottom) in native pixels crops the image right
+    after decoding, `size` then applies to the cropped region. torchvision.io.decode_jpeg has
+    no reduced-scale decoding, so the image stays a PIL image.
+    """
+    with Image.open(img_path) as img:
+        native_width, native_height = img.size
+        if size is not None:
+            crop_width, crop_height = (box[2] - box[0], box[3] - box[1]) if box is not None else img.size
+            img.draft('RGB', (-(-size * native_width // crop_width), -(-size * native_height // crop_height)))
+        if box is not None:
+            scale_x, scale_y = img.size[0] / native_width, img.size[1] / native_height
+            img = img.crop((int(box[0] * scale_x), int(box[1] * scale_y),
+                            int(np.ceil(box[2] * scale_x)), int(np.ceil(box[3] * scale_y))))
+        img = img.convert('RGB')
+    return img
+
+
+def retina_bbox(image, threshold=10, min_fraction=0.01):
+    """Bounding box (left, top, right, bottom) of the retina in a uint8 RGB array.
+
+    Pixels brighter than `threshold` in any channel count as retina. The box spans the rows
+    and columns whose projection profile covers more than `min_fraction` of the other axis,
+    which ignores isolated bright pixels such as burned-in text in the black border. Images
+    without any retina pixels keep the full frame.
+    """
+    mask = image.max(axis=2) > threshold
+    rows = np.flatnonzero(np.count_nonzero(mask, axis=1) > min_fraction * mask.shape[1])
+    cols = np.flatnonzero(np.count_nonzero(mask, axis=0) > min_fraction * mask.shape[0])
+    if rows.size == 0 or cols.size == 0:
+        return 0, 0, image.shape[1], image.shape[0]
+    return cols[0], rows[0], cols[-1] + 1, rows[-1] + 1
+
+
+def detect_retina_boxes(img_paths, threshold=10, detect_size=256):
+    """Retina boxes of `img_paths` in native pixels as an (N, 4) int32 array.
+
+    Each image is decoded at a reduced JPEG scale of at least `detect_size` and the box is
+    scaled back, rounding outwards so no retina pixels are lost.
+    """
+    boxes = np.empty((len(img_paths), 4), dtype=np.int32)
+    for i, img_path in enumerate(tqdm(img_paths, desc='Detecting retina boxes', unit=' image')):
+        with Image.open(img_path) as img:
+            native_width, native_height = img.size
+        image = np.asarray(decode_image(img_path, size=detect_size))
+        scale_x, scale_y = native_width / image.shape[1], native_height / image.shape[0]
+        left, top, right, bottom = retina_bbox(image, threshold)
+        boxes[i] = (int(left * scale_x), int(top * scale_y),
+                    min(native_width, int(np.ceil(right * scale_x))), min(native_height, int(np.ceil(bottom * scale_y))))
+    return boxes
+
+
 class ImagePreprocessor:
     @staticmethod
     def ben_graham_preprocessing(image):
@@ -60,8 +210,7 @@ class ImagePreprocessor:
     def circle_crop(image):
         image = np.array(image)
         height, width = image.shape[:2]
-        mask = np.zeros((height, width), np.uint8)
-        cv2.circle(mask, (width//2, height//2), min(width, height)//2, (255, 255, 255), -1)
+        mask = opencv_resources().circle_mask(height, width)
         masked_image = cv2.bitwise_and(image, image, mask=mask)
         return Image.fromarray(masked_image)
     
@@ -69,8 +218,7 @@ class ImagePreprocessor:
     def apply_clahe(image):
         image = np.array(image)
         lab = cv2.cvtColor(image, cv2.COLOR_RGB2LAB)
-        clahe = cv2.createCLAHE(clipLimit=2.0, tileGridSize=(8,8))
-        lab[:,:,0] = clahe.apply(lab[:,:,0])
+        lab[:,:,0] = opencv_resources().clahe().apply(lab[:,:,0])
         image = cv2.cvtColor(lab, cv2.COLOR_LAB2RGB)
         return Image.fromarray(image)
     
@@ -83,16 +231,497 @@ class ImagePreprocessor:
     @staticmethod
     def sharpen(image):
         image = np.array(image)
-        kernel = np.array([[-1,-1,-1], [-1,9,-1], [-1,-1,-1]])
-        sharpened = cv2.filter2D(image, -1, kernel)
+        sharpened = cv2.filter2D(image, -1, FusedPreprocessor.SHARPEN_KERNEL)
         return Image.fromarray(sharpened)
 
-class PreprocessingPipeline:
+# Order in which PreprocessingPipeline applies the steps, also used to build cache keys
+PREPROCESSING_STEPS = ['ben_graham', 'circle_crop', 'clahe', 'gaussian_blur', 'sharpen']
+# Bump whenever ImagePreprocessor changes so stale cache entries are not reused
+PREPROCESSING_CACHE_VERSION = 1
+# File names written by pack_dataset.py
+PACKED_IMAGES_FILE = 'images.npy'
+PACKED_INDEX_FILE = 'index.npz'
+# Annotation columns holding the retina box of each image when roi_crop is enabled
+ROI_COLUMNS = ['roi_left', 'roi_top', 'roi_right', 'roi_bottom']
+
+
+def enabled_preprocessing_steps(config):
+    return [step for step in PREPROCESSING_STEPS if config.get(step, False)]
+
+
+def preprocessing_config_name(config):
+    """Directory name materialize_preprocessing.py uses for a preprocessing config."""
+    return '_'.join(enabled_preprocessing_steps(config)) or 'none'
+
+
+class OpenCVResources:
+    """Reusable OpenCV objects and masks, one set per process and thread.
+
+    CLAHE objects are stateful (not thread-safe) and cannot be pickled, so preprocessors look
+    them up here through opencv_resources() instead of creating one per image or holding one,
+    which keeps datasets picklable for spawned DataLoader workers.
+    """
+    def __init__(self):
+        self.clahes = {}
+        self.masks = {}
+
+    def clahe(self, clip_limit=2.0, tile_grid_size=(8, 8)):
+        key = (clip_limit, tile_grid_size)
+        if key not in self.clahes:
+            self.clahes[key] = cv2.createCLAHE(clipLimit=clip_limit, tileGridSize=tile_grid_size)
+        return self.clahes[key]
+
+    def circle_mask(self, height, width, channels=1):
+        """0/255 mask of the centered inscribed circle, read-only since it is shared."""
+        key = (height, width, channels)
+        if key not in self.masks:
+            mask = np.zeros((height, width), np.uint8)
+            cv2.circle(mask, (width // 2, height // 2), min(width, height) // 2, 255, -1)
+            if channels > 1:
+                mask = cv2.merge([mask] * channels)
+            mask.setflags(write=False)
+            self.masks[key] = mask
+        return self.masks[key]
+
+
+_opencv_resources = threading.local()
+
+
+def opencv_resources():
+    if not hasattr(_opencv_resources, 'resources'):
+        _opencv_resources.resources = OpenCVResources()
+    return _opencv_resources.resources
+
+
+class FusedPreprocessor:
+    """Single-pass NumPy/OpenCV version of the ImagePreprocessor chain.
+
+    The image stays a uint8 array from decode to output instead of going through a
+    PIL -> NumPy -> PIL round trip per step. Scratch buffers are kept per image size, the
+    CLAHE object and circle masks come from opencv_resources(), and every OpenCV call writes
+    into a preallocated buffer, so only the returned array is allocated per image.
+    """
+    SHARPEN_KERNEL = np.array([[-1, -1, -1], [-1, 9, -1], [-1, -1, -1]])
+
     def __init__(self, config):
         self.config = config
+        self.buffers = {}
+
+    def get_buffers(self, shape):
+        if shape not in self.buffers:
+            height, width = shape[:2]
+            self.buffers[shape] = (
+                np.empty(shape, np.uint8),
+                np.empty(shape, np.uint8),
+                np.empty(shape, np.uint8),
+                np.empty((height, width), np.uint8)
+            )
+        return self.buffers[shape]
+
+    def get_mask(self, shape):
+        # Three-channel mask so the crop is a plain in-place bitwise AND
+        return opencv_resources().circle_mask(shape[0], shape[1], shape[2])
+
+    def process_array(self, image, scale=1.0, steps=None):
+        """Preprocess a uint8 RGB array, returns a new array.
+
+        `scale` is the ratio of the array's resolution to the native one the filter sizes were
+        tuned for. Ben Graham's sigma and the blur kernel shrink with it, CLAHE tiles and the
+        circle mask are relative to the image size already. `steps` overrides the steps
+        enabled in the config.
+        """
+        if steps is None:
+            steps = enabled_preprocessing_steps(self.config)
+        image = np.ascontiguousarray(image, dtype=np.uint8)
+        current, spare, scratch, channel = self.get_buffers(image.shape)
+        np.copyto(current, image)
+
+        for step in steps:
+            if self.apply_step(step, current, spare, scratch, channel, scale):
+                current, spare = spare, current
+
+        # Buffers are reused by the next call, so hand out a copy
+        return current.copy()
+
+    def apply_step(self, step, current, spare, scratch, channel, scale):
+        """Run one step on `current`, returns True if the result was written to `spare` instead."""
+        if step == 'ben_graham':
+            cv2.GaussianBlur(current, (0, 0), 10 * scale, dst=scratch)
+            cv2.addWeighted(current, 4, scratch, -4, 128, dst=spare)
+            return True
+        if step == 'circle_crop':
+            cv2.bitwise_and(current, self.get_mask(current.shape), dst=current)
+            return False
+        if step == 'clahe':
+            cv2.cvtColor(current, cv2.COLOR_RGB2LAB, dst=scratch)
+            cv2.extractChannel(scratch, 0, dst=channel)
+            opencv_resources().clahe().apply(channel, dst=channel)
+            cv2.insertChannel(channel, scratch, 0)
+            cv2.cvtColor(scratch, cv2.COLOR_LAB2RGB, dst=current)
+            return False
+        if step == 'gaussian_blur':
+            blur_size = max(3, int(round(5 * scale)) | 1)
+            cv2.GaussianBlur(current, (blur_size, blur_size), 0, dst=spare)
+            return True
+        if step == 'sharpen':
+            cv2.filter2D(current, -1, self.SHARPEN_KERNEL, dst=spare)
+            return True
+        raise ValueError(f"Unknown preprocessing step: {step}")
+
+    def process_image(self, image, scale=1.0):
+        return Image.fromarray(self.process_array(np.asarray(image), scale=scale))
+
+
+def downscale_for_enhancement(image, size, native_size=None):
+    """Resize a uint8 array to size x size if it is larger.
+
+    Returns the array with its linear scale relative to `native_size` (width, height), which
+    defaults to the array's own size and differs when the JPEG was decoded at a reduced scale.
+    """
+    height, width = image.shape[:2]
+    native_width, native_height = native_size or (width, height)
+    if height > size or width > size:
+        image = cv2.resize(image, (size, size), interpolation=cv2.INTER_AREA)
+        height, width = size, size
+    # Geometric mean of both axes, the resize does not keep the aspect ratio
+    return image, float(np.sqrt(width / native_width * height / native_height))
+
+
+class PreprocessingCache:
+    """Content-addressed on-disk cache of PreprocessingPipeline outputs.
+
+    Entries are keyed on the source image path, its mtime and size, the enabled
+    preprocessing steps and the working resolution, and stored as lossless PNGs.
+    """
+    def __init__(self, cache_dir, config, working_size=None, variant=''):
+        self.cache_dir = cache_dir
+        self.working_size = working_size
+        enabled_steps = enabled_preprocessing_steps(config)
+        self.signature = f"v{PREPROCESSING_CACHE_VERSION}|{','.join(enabled_steps)}|{working_size}|{variant}"
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def cache_path(self, img_path):
+        stat = os.stat(img_path)
+        key = f"{os.path.abspath(img_path)}|{stat.st_mtime_ns}|{stat.st_size}|{self.signature}"
+        digest = hashlib.sha1(key.encode('utf-8')).hexdigest()
+        return os.path.join(self.cache_dir, digest[:2], f'{digest}.png')
+
+    def load(self, cache_path):
+        if not os.path.exists(cache_path):
+            return None
+        with Image.open(cache_path) as img:
+            return img.convert('RGB')
+
+    def store(self, cache_path, image):
+        if self.working_size is not None and image.size != (self.working_size, self.working_size):
+            image = image.resize((self.working_size, self.working_size), Image.LANCZOS)
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        # Write to a temporary file first so concurrent readers never see a partial PNG
+        tmp_path = f'{cache_path}.{os.getpid()}.tmp'
+        image.save(tmp_path, format='PNG', compress_level=1)
+        os.replace(tmp_path, cache_path)
+        return image
+
+
+# Image quality grades in the DeepDRiD CSVs, keyed by the name used in AnnotationIndex
+QUALITY_COLUMNS = {
+    'overall_quality': 'Overall quality',
+    'clarity': 'Clarity',
+    'field_definition': 'Field definition',
+    'artifact': 'Artifact'
+}
+
+
+class SharedArray:
+    """NumPy array kept in a shared-memory tensor.
+
+    Forked workers map the same pages and spawned ones receive a handle to them instead
+    of a pickled copy. The NumPy view is rebuilt lazily in each process.
+    """
+    def __init__(self, values):
+        self.tensor = torch.from_numpy(np.array(values, order='C')).share_memory_()
+        self._array = None
+
+    def numpy(self):
+        if self._array is None:
+            self._array = self.tensor.numpy()
+        return self._array
+
+    def __array__(self, dtype=None, copy=None):
+        return self.numpy() if dtype is None else self.numpy().astype(dtype)
+
+    def __len__(self):
+        return len(self.tensor)
+
+    def __getitem__(self, index):
+        return self.numpy()[index]
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_array'] = None
+        return state
+
+
+class StringColumn:
+    """Strings stored as one UTF-8 byte buffer plus offsets, both SharedArrays.
+
+    A list or object array holds one refcounted Python string per sample, and merely
+    reading them in a forked worker writes to their pages, so every worker slowly ends
+    up with a private copy. Here a lookup only reads two offsets and a byte slice.
+    """
+    def __init__(self, values):
+        encoded = [str(value).encode('utf-8') for value in values]
+        offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        np.cumsum([len(value) for value in encoded], out=offsets[1:])
+        self.buffer = SharedArray(np.frombuffer(b''.join(encoded), dtype=np.uint8))
+        self.offsets = SharedArray(offsets)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, index):
+        offsets = self.offsets.numpy()
+        return self.buffer.numpy()[offsets[index]:offsets[index + 1]].tobytes().decode('utf-8')
+
+
+class AnnotationIndex:
+    """Columnar view of a DeepDRiD annotation CSV.
+
+    Every field is stored with one entry per sample in shared memory, strings as a
+    StringColumn and numbers as a SharedArray, so labels and class counts are available
+    without decoding any image and DataLoader workers share the metadata instead of
+    copying it. Indexing returns the fields of one sample as a dict, matching the
+    per-sample dicts RetinopathyDataset used to keep.
+    """
+    def __init__(self, columns):
+        self.columns = {
+            name: StringColumn(values) if np.asarray(values).dtype.kind in 'OSU' else SharedArray(values)
+            for name, values in columns.items()
+        }
+
+    def __len__(self):
+        return len(self.columns['img_path'] if 'img_path' in self.columns else self.columns['img_path1'])
+
+    def __getitem__(self, index):
+        return {name: values[index] for name, values in self.columns.items()}
+
+    @property
+    def labels(self):
+        return self.columns['dr_level'].numpy() if 'dr_level' in self.columns else None
+
+
+class PairIndex:
+    """Dual-mode view pairing rows of an image-level AnnotationIndex.
+
+    Only the two row arrays are per pair. Indexing returns the per-image fields of both
+    images with suffixes 1 and 2, the remaining fields (label, patient, quality) of the
+    first image, and image_row1/image_row2, the rows of the two images, which serve as
+    their image cache keys.
+    """
+    IMAGE_FIELDS = ('img_path', 'image_id', 'image_name', 'roi_box')
+
+    def __init__(self, images, first, second):
+        self.images = images
+        self.first = SharedArray(first)
+        self.second = SharedArray(second)
+
+    def __len__(self):
+        return len(self.first)
+
+    def __getitem__(self, index):
+        row1, row2 = int(self.first[index]), int(self.second[index])
+        sample = self.images[row1]
+        second = self.images[row2]
+        for field in self.IMAGE_FIELDS:
+            if field in sample:
+                sample[f'{field}1'] = sample.pop(field)
+                sample[f'{field}2'] = second[field]
+        sample['image_row1'], sample['image_row2'] = row1, row2
+        return sample
+
+    @property
+    def labels(self):
+        labels = self.images.labels
+        return None if labels is None else labels[self.first.numpy()]
+
+
+def build_pair_index(df):
+    """Pair the images of every (patient_id, eye) group of an annotation frame.
+
+    Groups are visited in sorted order and images in CSV order within a group, pairing
+    images 0-1, 2-3 and so on. The last image of an odd group is paired with the one before
+    it, so no image is dropped, and a group with a single image yields no pair. Returns the
+    row positions of the first and second image of each pair and the odd groups as
+    '<patient_id>_<eye>' strings.
+    """
+    ordered = df.reset_index(drop=True).sort_values(['patient_id', 'eye'], kind='stable')
+    rows = ordered.index.to_numpy()
+    groups = ordered.groupby(['patient_id', 'eye'], sort=False)
+    position = groups.cumcount().to_numpy()
+    size = groups['image_id'].transform('size').to_numpy()
+    odd = size % 2 == 1
+    starts = ((position % 2 == 0) & (position + 1 < size)) | (odd & (size > 1) & (position == size - 2))
+    starts = np.flatnonzero(starts)
+    odd_groups = ordered['patient_id'][odd & (position == 0)] + '_' + ordered['eye'][odd & (position == 0)]
+    return rows[starts], rows[starts + 1], odd_groups.to_numpy(dtype=str)
+
+
+class PackedImageStore:
+    """Read-only view of one split of a dataset packed by pack_dataset.py.
+
+    All images live in a single (N, size, size, 3) uint8 .npy file that is memory-mapped
+    on first access, so every DataLoader worker reads from the same page-cache copy.
+    """
+    def __init__(self, packed_dir, split, image_dir):
+        self.images_path = os.path.join(packed_dir, PACKED_IMAGES_FILE)
+        with np.load(os.path.join(packed_dir, PACKED_INDEX_FILE)) as index:
+            rows = np.flatnonzero(index['split'] == split)
+            if len(rows) == 0:
+                raise ValueError(f"Split '{split}' not found in packed dataset {packed_dir}")
+            # Sorted fixed-width path array for searchsorted lookups, unlike a dict of path
+            # strings it holds no refcounted objects whose pages workers would copy on write
+            paths = np.char.add(os.path.join(image_dir, ''), index['img_path'][rows])
+            order = np.argsort(paths)
+            self.paths = paths[order]
+            self.rows = rows[order]
+            self.size = int(index['size'])
+            self.preprocessing = [step for step in str(index['preprocessing']).split(',') if step]
+        self._images = None
+
+    @property
+    def images(self):
+        if self._images is None:
+            self._images = np.load(self.images_path, mmap_mode='r')
+        return self._images
+
+    def position(self, img_path):
+        i = np.searchsorted(self.paths, img_path)
+        if i == len(self.paths) or self.paths[i] != img_path:
+            raise KeyError(img_path)
+        return int(self.rows[i])
+
+    def get(self, img_path):
+        # Slicing the memmap returns a view, pixels are only paged in when read
+        return self.images[self.position(img_path)]
+
+    def __getstate__(self):
+        # Never pickle the mapped array itself, each worker re-opens the file instead
+        state = self.__dict__.copy()
+        state['_images'] = None
+        return state
+
+
+class SharedImageCache:
+    """Byte-budgeted LRU cache of decoded images shared by all DataLoader workers.
+
+    Images live in fixed-size slots of one shared-memory buffer allocated in the main
+    process, so every worker forked or spawned afterwards reads and fills the same copy.
+    Keys are integers in [0, num_keys), chosen by the owning dataset, which sizes the slots
+    from the images it decodes. Images larger than a slot are counted in num_skipped and not
+    cached, the first one with a warning.
+    """
+    def __init__(self, num_keys, max_bytes, slot_bytes):
+        self.slot_bytes = int(slot_bytes)
+        num_slots = int(min(num_keys, max_bytes // self.slot_bytes))
+        self.buffer = torch.zeros((num_slots, self.slot_bytes), dtype=torch.uint8).share_memory_()
+        self.slot_shape = torch.zeros((num_slots, 3), dtype=torch.int64).share_memory_()
+        self.slot_key = torch.full((num_slots,), -1, dtype=torch.int64).share_memory_()
+        # Slots that were never used keep 0 here, so the LRU pick fills empty slots first
+        self.slot_last_used = torch.zeros(num_slots, dtype=torch.int64).share_memory_()
+        self.key_slot = torch.full((num_keys,), -1, dtype=torch.int64).share_memory_()
+        self.clock = torch.zeros(1, dtype=torch.int64).share_memory_()
+        self.skipped = torch.zeros(1, dtype=torch.int64).share_memory_()
+        self.lock = multiprocessing.Lock()
+
+    @property
+    def num_skipped(self):
+        return int(self.skipped[0])
+
+    def _touch(self, slot):
+        self.clock += 1
+        self.slot_last_used[slot] = self.clock[0]
+
+    def get(self, key):
+        with self.lock:
+            slot = int(self.key_slot[key])
+            if slot < 0:
+                return None
+            self._touch(slot)
+            shape = tuple(self.slot_shape[slot].tolist())
+            # Copy out while holding the lock, the slot may be evicted right after
+            return self.buffer[slot, :int(np.prod(shape))].numpy().reshape(shape).copy()
+
+    def put(self, key, image):
+        image = np.ascontiguousarray(image, dtype=np.uint8)
+        if image.ndim != 3 or len(self.slot_key) == 0:
+            return
+        if image.nbytes > self.slot_bytes:
+            with self.lock:
+                self.skipped += 1
+                if self.skipped[0] == 1:
+                    print(f'Image cache: a {image.shape[1]}x{image.shape[0]} image does not fit the '
+                          f'{self.slot_bytes}-byte slots, images that large are not cached')
+            return
+        with self.lock:
+            if self.key_slot[key] >= 0:
+                return
+            slot = int(torch.argmin(self.slot_last_used))
+            evicted_key = int(self.slot_key[slot])
+            if evicted_key >= 0:
+                self.key_slot[evicted_key] = -1
+            self.buffer[slot, :image.nbytes].numpy()[:] = image.reshape(-1)
+            self.slot_shape[slot] = torch.tensor(image.shape)
+            self.slot_key[slot] = key
+            self.key_slot[key] = slot
+            self._touch(slot)
+
+
+class PreprocessingPipeline:
+    def __init__(self, config, cache=None, options=None):
+        self.config = config
+        self.options = options or {}
+        self.enhance_size = self.options.get('enhance_size')
         self.preprocessor = ImagePreprocessor()
-    
-    def process_image(self, image):
+        self.fused_preprocessor = None
+        if self.options.get('fused', False) or self.enhance_size is not None:
+            self.fused_preprocessor = FusedPreprocessor(config)
+        self.cache = cache
+
+    @property
+    def variant(self):
+        # Resize-before-enhance gives different pixels, keep its cache entries apart
+        return f'enhance@{self.enhance_size}' if self.enhance_size is not None else ''
+
+    def process_path(self, img_path, roi_box=None):
+        cache_path = None
+        if self.cache is not None:
+            cache_path = self.cache.cache_path(img_path)
+            cached = self.cache.load(cache_path)
+            if cached is not None:
+                return cached
+
+        if self.enhance_size is not None:
+            # The JPEG can already be decoded at a reduced scale, filter sizes follow the native size
+            if roi_box is not None:
+                native_size = (roi_box[2] - roi_box[0], roi_box[3] - roi_box[1])
+            else:
+                with Image.open(img_path) as img:
+                    native_size = img.size
+            image = self.process_image(decode_image(img_path, size=self.enhance_size, box=roi_box),
+                                       native_size=native_size)
+        else:
+            image = self.process_image(decode_image(img_path, box=roi_box))
+
+        if self.cache is not None:
+            image = self.cache.store(cache_path, image)
+        return image
+
+    def process_image(self, image, native_size=None):
+        if self.enhance_size is not None:
+            image, scale = downscale_for_enhancement(np.asarray(image), self.enhance_size, native_size)
+            return Image.fromarray(self.fused_preprocessor.process_array(image, scale=scale))
+        if self.fused_preprocessor is not None:
+            return self.fused_preprocessor.process_image(image)
         if self.config['ben_graham']:
             image = self.preprocessor.ben_graham_preprocessing(image)
         if self.config['circle_crop']:
@@ -106,46 +735,165 @@ class PreprocessingPipeline:
         return image
 
 class RetinopathyDataset(Dataset):
-    def __init__(self, ann_file, image_dir, transform=None, mode='single', test=False, preprocessing_config=None):
+    def __init__(self, ann_file, image_dir, transform=None, mode='single', test=False, preprocessing_config=None,
+                 cache_config=None, packed_dir=None, split=None, decode_size=None, image_cache_config=None,
+                 preprocessing_options=None, roi_config=None):
         self.ann_file = ann_file
         self.image_dir = image_dir
         self.transform = transform
         self.test = test
         self.mode = mode
-        self.preprocessing_pipeline = PreprocessingPipeline(preprocessing_config) if preprocessing_config else None
+        self.decode_size = decode_size
+        self.packed_store = PackedImageStore(packed_dir, split, image_dir) if packed_dir else None
+        self.roi_config = roi_config if roi_config and roi_config.get('enabled', False) else None
+        if self.roi_config is not None and self.packed_store is not None:
+            raise ValueError('Packed images are already resized, retina cropping needs the source images')
+
+        if self.packed_store is not None and self.packed_store.preprocessing:
+            # Preprocessing was baked in when packing, it must match what was requested
+            requested_steps = enabled_preprocessing_steps(preprocessing_config or {})
+            if requested_steps != self.packed_store.preprocessing:
+                raise ValueError(
+                    f"Packed dataset was preprocessed with {self.packed_store.preprocessing}, "
+                    f"but {requested_steps} was requested"
+                )
+            preprocessing_config = None
+
+        self.preprocessing_pipeline = None
+        if preprocessing_config:
+            self.preprocessing_pipeline = PreprocessingPipeline(preprocessing_config, options=preprocessing_options)
+            if cache_config and cache_config.get('enabled', False) and self.packed_store is None:
+                self.preprocessing_pipeline.cache = PreprocessingCache(
+                    cache_config['cache_dir'],
+                    preprocessing_config,
+                    working_size=cache_config.get('working_size'),
+                    variant=self.cache_variant()
+                )
 
         if self.mode == 'single':
             self.data = self.load_data()
         else:
             self.data = self.load_data_dual()
 
+        self.image_cache = None
+        if image_cache_config and image_cache_config.get('enabled', False):
+            self.image_cache = self.create_image_cache(image_cache_config)
+
     def __len__(self):
         return len(self.data)
 
+    def create_image_cache(self, image_cache_config):
+        """SharedImageCache with slots sized for the largest of a few images decoded up front."""
+        # One key per image, its annotation row, so an image in several pairs is decoded once
+        images = self.data if self.mode == 'single' else self.data.images
+        if len(images) == 0:
+            return None
+        probes = {}
+        for key in np.linspace(0, len(images) - 1, min(len(images), image_cache_config['size_probes'])).astype(int):
+            row = images[int(key)]
+            probes[int(key)] = np.asarray(self.decode(row['img_path'], row.get('roi_box')))
+        slot_bytes = max(image.nbytes for image in probes.values())
+        cache = SharedImageCache(len(images), image_cache_config['max_bytes'], slot_bytes)
+        for key, image in probes.items():
+            cache.put(key, image)
+        return cache
+
+    def cache_variant(self):
+        variant = self.preprocessing_pipeline.variant
+        if self.roi_config is not None:
+            # Boxes are a function of the image and the threshold, so those identify the crop
+            variant += f"|roi@{self.roi_config['threshold']}"
+        return variant
+
+    def load_roi_boxes(self, img_paths):
+        """Retina boxes of `img_paths`, detected once and kept in <ann_file>_roi.npz."""
+        roi_file = f'{os.path.splitext(self.ann_file)[0]}_roi.npz'
+        signature = f"{self.roi_config['threshold']}|{self.roi_config['detect_size']}"
+        if os.path.exists(roi_file):
+            with np.load(roi_file) as stored:
+                if str(stored['signature']) == signature and np.array_equal(stored['img_path'], img_paths):
+                    return stored['boxes']
+        boxes = detect_retina_boxes(img_paths, self.roi_config['threshold'], self.roi_config['detect_size'])
+        tmp_file = f'{roi_file}.{os.getpid()}.tmp.npz'
+        np.savez(tmp_file, img_path=img_paths, boxes=boxes, signature=np.str_(signature))
+        os.replace(tmp_file, roi_file)
+        return boxes
+
     def __getitem__(self, index):
         if self.mode == 'single':
             return self.get_item(index)
         else:
             return self.get_item_dual(index)
 
-    def load_data(self):
+    @property
+    def labels(self):
+        if self.test:
+            raise ValueError('Test datasets have no labels')
+        return self.data.labels
+
+    def class_counts(self, num_classes=num_classes):
+        return np.bincount(self.labels, minlength=num_classes)
+
+    def read_annotations(self):
         df = pd.read_csv(self.ann_file)
-        data = []
-        for _, row in df.iterrows():
-            file_info = dict()
-            file_info['img_path'] = os.path.join(self.image_dir, row['img_path'])
-            if not self.test:
-                file_info['dr_level'] = int(row['patient_DR_Level'])
-            data.append(file_info)
-        return data
+        # File name used as ID in prediction files, materialized copies keep the original one
+        source_path = df['source_img_path'] if 'source_img_path' in df else df['img_path']
+        df['image_name'] = source_path.str.split('/').str[-1]
+        # Joining with an empty name yields the directory with a trailing separator
+        df['img_path'] = os.path.join(self.image_dir, '') + df['img_path']
+        image_id = df['image_id'].str.split('_', n=1)
+        df['patient_id'] = image_id.str[0]
+        df['eye'] = image_id.str[1].str[0]
+        if self.roi_config is not None:
+            df[ROI_COLUMNS] = self.load_roi_boxes(df['img_path'].to_numpy(dtype=str))
+        return df
+
+    def columns_from_frame(self, df, path_columns):
+        columns = {name: df[column].to_numpy(dtype=str) for name, column in path_columns.items()}
+        columns['patient_id'] = df['patient_id'].to_numpy(dtype=str)
+        columns['eye'] = df['eye'].to_numpy(dtype=str)
+        if not self.test:
+            columns['dr_level'] = df['patient_DR_Level'].to_numpy(dtype=np.int64)
+        for name, column in QUALITY_COLUMNS.items():
+            if column in df:
+                columns[name] = df[column].to_numpy()
+        return columns
+
+    def load_data(self):
+        return self.image_index(self.read_annotations())
+
+    def image_index(self, df):
+        columns = self.columns_from_frame(df, {
+            'img_path': 'img_path', 'image_id': 'image_id', 'image_name': 'image_name'
+        })
+        if self.roi_config is not None:
+            columns['roi_box'] = df[ROI_COLUMNS].to_numpy(dtype=np.int32)
+        return AnnotationIndex(columns)
+
+    def load_image(self, img_path, cache_key=None, roi_box=None):
+        if self.image_cache is not None and cache_key is not None:
+            cached = self.image_cache.get(cache_key)
+            if cached is not None:
+                return Image.fromarray(cached)
+            img = self.decode(img_path, roi_box)
+            self.image_cache.put(cache_key, np.asarray(img))
+            return img
+        return self.decode(img_path, roi_box)
+
+    def decode(self, img_path, roi_box=None):
+        if self.packed_store is not None:
+            img = Image.fromarray(self.packed_store.get(img_path))
+            if self.preprocessing_pipeline:
+                img = self.preprocessing_pipeline.process_image(img)
+            return img
+        if self.preprocessing_pipeline:
+            return self.preprocessing_pipeline.process_path(img_path, roi_box)
+        return decode_image(img_path, size=self.decode_size, box=roi_box)
 
     def get_item(self, index):
         data = self.data[index]
-        img = Image.open(data['img_path']).convert('RGB')
-        
-        if self.preprocessing_pipeline:
-            img = self.preprocessing_pipeline.process_image(img)
-            
+        img = self.load_image(data['img_path'], cache_key=index, roi_box=data.get('roi_box'))
+
         if self.transform:
             img = self.transform(img)
 
@@ -156,29 +904,44 @@ class RetinopathyDataset(Dataset):
             return img
 
     def load_data_dual(self):
-        df = pd.read_csv(self.ann_file)
-        df['prefix'] = df['image_id'].str.split('_').str[0]
-        df['suffix'] = df['image_id'].str.split('_').str[1].str[0]
-        grouped = df.groupby(['prefix', 'suffix'])
-
-        data = []
-        for (prefix, suffix), group in grouped:
-            file_info = dict()
-            file_info['img_path1'] = os.path.join(self.image_dir, group.iloc[0]['img_path'])
-            file_info['img_path2'] = os.path.join(self.image_dir, group.iloc[1]['img_path'])
-            if not self.test:
-                file_info['dr_level'] = int(group.iloc[0]['patient_DR_Level'])
-            data.append(file_info)
-        return data
+        df = self.read_annotations()
+        first, second = self.load_pair_index(df)
+        return PairIndex(self.image_index(df), first, second)
+
+    def load_pair_index(self, df):
+        """Rows of the paired images, built once by build_pair_index and kept in <ann_file>_pairs.npz."""
+        pair_file = f'{os.path.splitext(self.ann_file)[0]}_pairs.npz'
+        image_ids = df['image_id'].to_numpy(dtype=str)
+        if os.path.exists(pair_file):
+            with np.load(pair_file) as stored:
+                first, second = stored['first'], stored['second']
+                # A stale table no longer points at the same images
+                if np.array_equal(stored['image_id'], image_ids):
+                    return first, second
+
+        first, second, odd_groups = build_pair_index(df)
+        if np.any(first == second) or np.any(df['patient_id'].to_numpy()[first] != df['patient_id'].to_numpy()[second]) \
+                or np.any(df['eye'].to_numpy()[first] != df['eye'].to_numpy()[second]):
+            raise ValueError(f'Invalid image pairs built from {self.ann_file}')
+        if len(odd_groups):
+            print(f'{len(odd_groups)} (patient, eye) groups in {self.ann_file} have an odd number of images, '
+                  f'the last one is paired with the image before it and single images are left out: '
+                  f'{", ".join(odd_groups[:10])}')
+        if not self.test:
+            labels = df['patient_DR_Level'].to_numpy()
+            mismatched = np.count_nonzero(labels[first] != labels[second])
+            if mismatched:
+                print(f'{mismatched} pairs in {self.ann_file} have different labels, using the first image\'s')
+
+        tmp_file = f'{pair_file}.{os.getpid()}.tmp.npz'
+        np.savez(tmp_file, first=first, second=second, image_id=image_ids, odd_groups=odd_groups)
+        os.replace(tmp_file, pair_file)
+        return first, second
 
     def get_item_dual(self, index):
         data = self.data[index]
-        img1 = Image.open(data['img_path1']).convert('RGB')
-        img2 = Image.open(data['img_path2']).convert('RGB')
-
-        if self.preprocessing_pipeline:
-            img1 = self.preprocessing_pipeline.process_image(img1)
-            img2 = self.preprocessing_pipeline.process_image(img2)
+        img1 = self.load_image(data['img_path1'], cache_key=data['image_row1'], roi_box=data.get('roi_box1'))
+        img2 = self.load_image(data['img_path2'], cache_key=data['image_row2'], roi_box=data.get('roi_box2'))
 
         if self.transform:
             img1 = self.transform(img1)
@@ -190,6 +953,80 @@ class RetinopathyDataset(Dataset):
         else:
             return [img1, img2]
 
+class DynamicOversampler(WeightedRandomSampler):
+    """Class-balanced WeightedRandomSampler built from annotation labels only.
+
+    Each sample is weighted by the 'balanced' class weight of its label, so every class is
+    drawn about equally often. `class_weights` holds one weight per class (1.0 for classes
+    absent from `labels`) and can be passed on to a weighted CrossEntropyLoss.
+    """
+    def __init__(self, labels, num_classes=num_classes, generator=None):
+        labels = np.asarray(labels, dtype=np.int64)
+        present_classes = np.unique(labels)
+        self.class_weights = np.ones(num_classes)
+        self.class_weights[present_classes] = compute_class_weight('balanced', classes=present_classes, y=labels)
+        sample_weights = torch.as_tensor(self.class_weights[labels], dtype=torch.double)
+        super().__init__(weights=sample_weights, num_samples=len(labels), replacement=True, generator=generator)
+
+
+class ResumableSampler(Sampler):
+    """Wraps a sampler drawing from `generator` so an epoch can restart part way through.
+
+    The DataLoader draws the workers' base seed from the same generator whenever it starts a
+    new iterator: every epoch, or only for the first one with persistent_workers. Through
+    ResumableDataLoader the sampler records the generator state before that draw and before
+    each epoch's order. state_dict() stores the states the resumed position starts from, and
+    after load_state_dict() the resumed loader's first iterator redraws the same base seed
+    and the next epoch the same order, skipping the samples already trained on. The following
+    epochs then draw the same orders as the uninterrupted run.
+    """
+    def __init__(self, sampler, generator):
+        self.sampler = sampler
+        self.generator = generator
+        self.iterator_state = generator.get_state()
+        self.epoch_state = generator.get_state()
+        self.reuses_iterator = False
+        self._resume = None
+
+    def __len__(self):
+        return len(self.sampler)
+
+    def start_iterator(self, reuses_iterator):
+        """Called before a new DataLoader iterator draws its base seed, `reuses_iterator` for persistent workers."""
+        self.iterator_state = self.generator.get_state()
+        self.reuses_iterator = reuses_iterator
+
+    def __iter__(self):
+        skip = 0
+        if self._resume is not None:
+            epoch_state, skip = self._resume
+            self.generator.set_state(epoch_state)
+            self._resume = None
+        self.epoch_state = self.generator.get_state()
+        return itertools.islice(iter(self.sampler), skip, None)
+
+    def state_dict(self, position):
+        if position or self.reuses_iterator:
+            # The resumed position is served by the current iterator
+            epoch_state = self.epoch_state if position else self.generator.get_state()
+            return {'iterator_state': self.iterator_state, 'epoch_state': epoch_state, 'position': position}
+        # The next epoch starts a new iterator, which draws its base seed and then the order
+        return {'iterator_state': self.generator.get_state(), 'epoch_state': None, 'position': 0}
+
+    def load_state_dict(self, state):
+        self.generator.set_state(state['iterator_state'])
+        if state['epoch_state'] is not None:
+            self._resume = (state['epoch_state'], state['position'])
+
+
+class ResumableDataLoader(DataLoader):
+    """DataLoader telling its ResumableSampler when a new iterator draws the workers' base seed."""
+    def _get_iterator(self):
+        if isinstance(self.sampler, ResumableSampler):
+            self.sampler.start_iterator(self.persistent_workers and self.num_workers > 0)
+        return super()._get_iterator()
+
+
 class CutOut(object):
     def __init__(self, mask_size, p=0.5):
         self.mask_size = mask_size
@@ -252,6 +1089,117 @@ class GammaCorrection:
     def __call__(self, img):
         return adjust_gamma(img, gamma=self.gamma)
 
+
+class BrightnessGammaLUT:
+    """ColorJitter(brightness) followed by GammaCorrection as one 256-entry lookup table.
+
+    Both are pointwise maps of uint8 values, so their composition is tabulated per sample
+    with the same integer rounding as the PIL implementations and applied to the PIL image
+    in a single pass. The output stays uint8, convert with PILToTensor and normalize the
+    batch with NormalizeBatch.
+    """
+    def __init__(self, brightness=(0.1, 0.9), gamma=1.5):
+        self.brightness = brightness
+        # Same table torchvision's adjust_gamma builds for PIL images
+        self.gamma_map = np.array([int((255 + 1 - 1e-3) * pow(value / 255.0, gamma)) for value in range(256)],
+                                  dtype=np.uint8)
+
+    def __call__(self, img):
+        factor = float(torch.empty(1).uniform_(*self.brightness))
+        # PIL's brightness blend with black computes factor * value in float32 and truncates
+        brightened = (np.float32(factor) * np.arange(256, dtype=np.float32)).astype(np.uint8)
+        return img.point(self.gamma_map[brightened].tolist() * len(img.getbands()))
+
+
+class NormalizeBatch:
+    """ToTensor scaling and Normalize for a collated uint8 batch, run where the batch lives."""
+    def __init__(self, mean=(0.485, 0.456, 0.406), std=(0.229, 0.224, 0.225)):
+        self.mean = torch.tensor(mean).view(1, -1, 1, 1)
+        self.std = torch.tensor(std).view(1, -1, 1, 1)
+
+    def __call__(self, images):
+        if isinstance(images, (list, tuple)):
+            return [self(img) for img in images]
+        device = images.device
+        return images.float().div_(255).sub_(self.mean.to(device)).div_(self.std.to(device))
+
+
+class SingleWarpAugmentation:
+    """Resize, RandomCrop, SLORandomPad, FundRandomRotate and both flips as one warpAffine.
+
+    Draws the same parameters as the transform_train steps (crop and flips from torch, pad and
+    rotation from `random`), composes them into one affine matrix from the decoded image to
+    the output and resamples once. Only the source region under the crop window, plus one pixel
+    per side for the bilinear taps on its edges, is read, and everything the window does not
+    cover is masked to black like the padding and rotation fill. Sources more than twice the
+    size of that window are first reduced with INTER_AREA, bilinear warping alone would alias there.
+    """
+    def __init__(self, resize=256, crop_size=210, output_size=224, rotate_prob=0.5, degree=30, flip_prob=0.5):
+        self.resize = resize
+        self.crop_size = crop_size
+        self.output_size = output_size
+        self.rotate_prob = rotate_prob
+        self.degree = degree
+        self.flip_prob = flip_prob
+
+    def __call__(self, img):
+        image = np.asarray(img)
+        height, width = image.shape[:2]
+        scale_x, scale_y = self.resize / width, self.resize / height
+
+        crop_top = int(torch.randint(0, self.resize - self.crop_size + 1, size=(1,)))
+        crop_left = int(torch.randint(0, self.resize - self.crop_size + 1, size=(1,)))
+        max_pad = max(0, self.output_size - self.crop_size)
+        pad_left = random.randint(0, max_pad)
+        pad_top = random.randint(0, max_pad)
+
+        # Source pixels under the crop window, pixel edges at (x + 0.5) / scale - 0.5, plus the
+        # neighbours its edge pixels interpolate with
+        left = max(0, int(np.floor(crop_left / scale_x)) - 1)
+        top = max(0, int(np.floor(crop_top / scale_y)) - 1)
+        right = min(width, int(np.ceil((crop_left + self.crop_size) / scale_x)) + 1)
+        bottom = min(height, int(np.ceil((crop_top + self.crop_size) / scale_y)) + 1)
+        region = image[top:bottom, left:right]
+
+        # Source -> resized -> cropped -> padded canvas, on pixel centers
+        matrix = np.array([
+            [scale_x, 0, (left + 0.5) * scale_x - 0.5 - crop_left + pad_left],
+            [0, scale_y, (top + 0.5) * scale_y - 0.5 - crop_top + pad_top],
+            [0, 0, 1]
+        ])
+        shrink = 2 * self.crop_size / max(region.shape[:2])
+        if shrink < 1:
+            region_width = max(1, round(region.shape[1] * shrink))
+            region_height = max(1, round(region.shape[0] * shrink))
+            shrink_x, shrink_y = region.shape[1] / region_width, region.shape[0] / region_height
+            region = cv2.resize(region, (region_width, region_height), interpolation=cv2.INTER_AREA)
+            matrix = matrix @ np.array([[shrink_x, 0, 0.5 * shrink_x - 0.5], [0, shrink_y, 0.5 * shrink_y - 0.5],
+                                        [0, 0, 1]])
+
+        # Padded canvas -> output
+        placement = np.eye(3)
+        if random.random() < self.rotate_prob:
+            angle = random.uniform(-self.degree, self.degree)
+            center = ((self.output_size - 1) / 2, (self.output_size - 1) / 2)
+            # Positive angles rotate counter-clockwise, like transforms.functional.rotate
+            placement = np.vstack([cv2.getRotationMatrix2D(center, angle, 1.0), [0, 0, 1]]) @ placement
+        if torch.rand(1) < self.flip_prob:
+            placement = np.array([[-1, 0, self.output_size - 1], [0, 1, 0], [0, 0, 1]]) @ placement
+        if torch.rand(1) < self.flip_prob:
+            placement = np.array([[1, 0, 0], [0, -1, self.output_size - 1], [0, 0, 1]]) @ placement
+
+        size = (self.output_size, self.output_size)
+        # Replicated borders stand in for the image edge, like Resize, the mask blacks out the rest
+        warped = cv2.warpAffine(region, (placement @ matrix)[:2], size, flags=cv2.INTER_LINEAR,
+                                borderMode=cv2.BORDER_REPLICATE)
+        window = np.zeros(size, dtype=np.uint8)
+        window[pad_top:pad_top + self.crop_size, pad_left:pad_left + self.crop_size] = 1
+        # Nearest, like the rotation of the padded crop in transform_train
+        window = cv2.warpAffine(window, placement[:2], size, flags=cv2.INTER_NEAREST,
+                                borderMode=cv2.BORDER_CONSTANT, borderValue=0)
+        warped[window == 0] = 0
+        return Image.fromarray(warped)
+
 transform_train = transforms.Compose([
     transforms.Resize((256, 256)),
     transforms.RandomCrop((210, 210)),
@@ -271,11 +1219,675 @@ transform_test = transforms.Compose([
     transforms.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225])
 ])
 
+# Per-image part of the batched training pipeline, BatchAugmentation does the rest
+transform_train_uint8 = transforms.Compose([
+    transforms.Resize((256, 256)),
+    transforms.PILToTensor()
+])
+
+transform_test_uint8 = transforms.Compose([
+    transforms.Resize((224, 224)),
+    transforms.PILToTensor()
+])
+
+# transform_train with brightness and gamma fused into one uint8 LUT, NormalizeBatch does the rest
+transform_train_lut = transforms.Compose([
+    transforms.Resize((256, 256)),
+    transforms.RandomCrop((210, 210)),
+    SLORandomPad((224, 224)),
+    FundRandomRotate(prob=0.5, degree=30),
+    transforms.RandomHorizontalFlip(p=0.5),
+    transforms.RandomVerticalFlip(p=0.5),
+    BrightnessGammaLUT(brightness=(0.1, 0.9), gamma=1.5),
+    transforms.PILToTensor()
+])
+
+
+def train_transforms(augmentation_config, uint8=False):
+    """Per-image train transform and the batch_transform train_model applies to its output.
+
+    `uint8` makes the per-image transform end in uint8 tensors even without lut_color.
+    """
+    if augmentation_config['batched']:
+        return transform_train_uint8, BatchAugmentation()
+    if not augmentation_config['single_warp']:
+        if augmentation_config['lut_color']:
+            return transform_train_lut, NormalizeBatch()
+        if not uint8:
+            return transform_train, None
+        geometric = transform_train.transforms[:6]
+    else:
+        geometric = [SingleWarpAugmentation()]
+    if augmentation_config['lut_color']:
+        return transforms.Compose(geometric + [
+            BrightnessGammaLUT(brightness=(0.1, 0.9), gamma=1.5),
+            transforms.PILToTensor()
+        ]), NormalizeBatch()
+    color = [transforms.ColorJitter(brightness=(0.1, 0.9)), GammaCorrection(gamma=1.5)]
+    if uint8:
+        return transforms.Compose(geometric + color + [transforms.PILToTensor()]), NormalizeBatch()
+    return transforms.Compose(geometric + color + [
+        transforms.ToTensor(),
+        transforms.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225])
+    ]), None
+
+
+class BatchAugmentation:
+    """Batched tensor version of the random part of transform_train.
+
+    Takes a collated uint8 batch of 256x256 images (see transform_train_uint8) and draws
+    RandomCrop, SLORandomPad, FundRandomRotate and flip parameters per sample. They are folded
+    into one sampling grid so the whole batch is resampled by a single grid_sample call, then
+    brightness, gamma, Normalize and optionally CutOut are applied as batch-wide tensor ops.
+    """
+    def __init__(self, crop_size=210, output_size=224, rotate_prob=0.5, degree=30, flip_prob=0.5,
+                 brightness=(0.1, 0.9), gamma=1.5, cutout_size=None, cutout_prob=0.5,
+                 mean=(0.485, 0.456, 0.406), std=(0.229, 0.224, 0.225)):
+        self.crop_size = crop_size
+        self.output_size = output_size
+        self.rotate_prob = rotate_prob
+        self.degree = degree
+        self.flip_prob = flip_prob
+        self.brightness = brightness
+        self.gamma = gamma
+        self.cutout_size = cutout_size
+        self.cutout_prob = cutout_prob
+        self.mean = torch.tensor(mean).view(1, -1, 1, 1)
+        self.std = torch.tensor(std).view(1, -1, 1, 1)
+
+    def __call__(self, images):
+        if isinstance(images, (list, tuple)):
+            return [self(img) for img in images]
+
+        batch_size, _, height, width = images.shape
+        device = images.device
+        grid = self.sample_grid(batch_size, height, width, device)
+        images = F.grid_sample(images.float(), grid, mode='bilinear', padding_mode='zeros', align_corners=False)
+
+        # ColorJitter brightness and GammaCorrection, both pointwise per sample
+        low, high = self.brightness
+        factor = torch.empty(batch_size, 1, 1, 1, device=device).uniform_(low, high)
+        images = (images * factor).clamp_(0, 255).div_(255).pow_(self.gamma)
+
+        images = (images - self.mean.to(device)) / self.std.to(device)
+        if self.cutout_size is not None:
+            images = images * self.cutout_mask(batch_size, device)
+        return images
+
+    def sample_grid(self, batch_size, height, width, device):
+        size = self.output_size
+        # Output pixel centers, in pixels of the padded output canvas
+        coords = torch.arange(size, device=device, dtype=torch.float32) + 0.5
+        y, x = torch.meshgrid(coords, coords, indexing='ij')
+        x = x.expand(batch_size, size, size)
+        y = y.expand(batch_size, size, size)
+
+        # Undo the flips
+        hflip = (torch.rand(batch_size, 1, 1, device=device) < self.flip_prob)
+        vflip = (torch.rand(batch_size, 1, 1, device=device) < self.flip_prob)
+        x = torch.where(hflip, size - x, x)
+        y = torch.where(vflip, size - y, y)
+
+        # Undo the rotation about the canvas center
+        rotate = torch.rand(batch_size, 1, 1, device=device) < self.rotate_prob
+        angle = torch.empty(batch_size, 1, 1, device=device).uniform_(-self.degree, self.degree)
+        angle = torch.deg2rad(angle) * rotate
+        cos, sin = torch.cos(angle), torch.sin(angle)
+        center = size / 2
+        x, y = cos * (x - center) - sin * (y - center) + center, sin * (x - center) + cos * (y - center) + center
+
+        # Undo SLORandomPad, then RandomCrop
+        max_pad = size - self.crop_size
+        pad_left = torch.randint(0, max_pad + 1, (batch_size, 1, 1), device=device)
+        pad_top = torch.randint(0, max_pad + 1, (batch_size, 1, 1), device=device)
+        x = x - pad_left
+        y = y - pad_top
+        inside = (x >= 0) & (x < self.crop_size) & (y >= 0) & (y < self.crop_size)
+        crop_left = torch.randint(0, width - self.crop_size + 1, (batch_size, 1, 1), device=device)
+        crop_top = torch.randint(0, height - self.crop_size + 1, (batch_size, 1, 1), device=device)
+        x = x + crop_left
+        y = y + crop_top
+
+        # Normalized source coordinates, pixels from the padding are pushed out of range
+        grid = torch.stack([2 * x / width - 1, 2 * y / height - 1], dim=-1)
+        return torch.where(inside.unsqueeze(-1), grid, torch.full_like(grid, -2.0))
+
+    def cutout_mask(self, batch_size, device):
+        size = self.output_size
+        half = self.cutout_size // 2
+        offset = 1 if self.cutout_size % 2 == 0 else 0
+        cx = torch.randint(half, size + offset - half, (batch_size, 1, 1), device=device)
+        cy = torch.randint(half, size + offset - half, (batch_size, 1, 1), device=device)
+        coords = torch.arange(size, device=device)
+        in_x = (coords.view(1, 1, -1) >= cx - half) & (coords.view(1, 1, -1) < cx + half + offset)
+        in_y = (coords.view(1, -1, 1) >= cy - half) & (coords.view(1, -1, 1) < cy + half + offset)
+        apply = torch.rand(batch_size, 1, 1, device=device) < self.cutout_prob
+        return (~(in_x & in_y & apply)).unsqueeze(1).float()
+
+
+def collate_uint8(batch):
+    """Collate uint8 CHW images with their labels, for single, dual and label-less samples.
+
+    In a worker the images are stacked straight into shared memory, so the batch is not
+    copied again on its way to the main process. Float images raise a TypeError, a transform
+    still ending in ToTensor/Normalize would otherwise silently send 4x the bytes.
+    """
+    elem = batch[0]
+    if isinstance(elem, (list, tuple)):
+        return [collate_uint8(samples) for samples in zip(*batch)]
+    if elem.dim() < 3:
+        return torch.stack(batch)
+    if elem.dtype != torch.uint8:
+        raise TypeError(f'collate_uint8 expects uint8 images, got {elem.dtype}')
+    out = torch.empty((len(batch),) + tuple(elem.shape), dtype=torch.uint8)
+    if torch.utils.data.get_worker_info() is not None:
+        out.share_memory_()
+    return torch.stack(batch, out=out)
+
+
+def map_tensors(batch, fn):
+    if isinstance(batch, torch.Tensor):
+        return fn(batch)
+    if isinstance(batch, (list, tuple)):
+        return type(batch)(map_tensors(item, fn) for item in batch)
+    return batch
+
+
+def process_memory(pid):
+    """(RSS, private) bytes of a process, read from /proc. None where that is unavailable."""
+    try:
+        with open(f'/proc/{pid}/smaps_rollup') as f:
+            fields = dict(line.split(':', 1) for line in f if ':' in line)
+    except OSError:
+        return None
+    kib = {name: int(value.split()[0]) * 1024 for name, value in fields.items() if value.strip().endswith('kB')}
+    return kib.get('Rss', 0), kib.get('Private_Clean', 0) + kib.get('Private_Dirty', 0)
+
+
+class WorkerMemoryReport:
+    """Per-epoch memory of the training process and the DataLoader workers of `loader`.
+
+    Private memory is what a worker no longer shares with the training process. With the
+    shared AnnotationIndex it should stay flat across epochs, growing RSS alone only means
+    more shared pages (e.g. the image cache) were touched.
+    """
+    def __init__(self, loader):
+        self.loader = loader
+        self.history = []
+
+    def worker_pids(self):
+        # Persistent workers outlive the epoch and hang off the loader's cached iterator
+        iterator = getattr(self.loader, '_iterator', None)
+        return [worker.pid for worker in getattr(iterator, '_workers', [])]
+
+    def record(self, epoch):
+        processes = {'main': os.getpid()}
+        processes.update({f'worker{i}': pid for i, pid in enumerate(self.worker_pids())})
+        usage = {name: process_memory(pid) for name, pid in processes.items()}
+        usage = {name: memory for name, memory in usage.items() if memory is not None}
+        self.history.append({'epoch': epoch, **usage})
+        if usage:
+            print('Memory RSS/private (MiB): ' + ', '.join(
+                f'{name} {rss / 2 ** 20:.0f}/{private / 2 ** 20:.0f}' for name, (rss, private) in usage.items()
+            ))
+
+
+class TransformedBatches:
+    """Iterate a loader with `batch_transform` applied to the images of each batch."""
+    def __init__(self, loader, batch_transform):
+        self.loader = loader
+        self.batch_transform = batch_transform
+
+    def __len__(self):
+        return len(self.loader)
+
+    def __iter__(self):
+        for images, *rest in self.loader:
+            yield (self.batch_transform(images), *rest)
+
+
+class BatchPrefetcher:
+    """Wrap a DataLoader so up to `num_batches` batches are fetched ahead on a background thread.
+
+    Batches are pinned and moved to `device` with non-blocking copies (on a side stream for
+    CUDA), so loading and host-to-device transfers overlap with forward/backward. Works for
+    single-tensor, dual [img1, img2] and label-less batch layouts.
+    """
+    _END = object()
+
+    def __init__(self, loader, device, num_batches=2):
+        self.loader = loader
+        self.device = torch.device(device)
+        self.num_batches = num_batches
+
+    def __len__(self):
+        return len(self.loader)
+
+    def to_device(self, tensor):
+        if self.device.type == 'cuda' and not tensor.is_pinned():
+            tensor = tensor.pin_memory()
+        return tensor.to(self.device, non_blocking=True)
+
+    def __iter__(self):
+        ready = queue.Queue(maxsize=self.num_batches)
+        stop = threading.Event()
+        stream = torch.cuda.Stream(self.device) if self.device.type == 'cuda' else None
+
+        def produce():
+            try:
+                for batch in self.loader:
+                    if stop.is_set():
+                        return
+                    event = None
+                    if stream is not None:
+                        with torch.cuda.stream(stream):
+                            batch = map_tensors(batch, self.to_device)
+                            event = torch.cuda.Event()
+                            event.record(stream)
+                    else:
+                        batch = map_tensors(batch, self.to_device)
+                    ready.put((batch, event))
+                ready.put(self._END)
+            except Exception as e:
+                ready.put(e)
+
+        thread = threading.Thread(target=produce, daemon=True)
+        thread.start()
+        try:
+            while True:
+                item = ready.get()
+                if item is self._END:
+                    break
+                if isinstance(item, Exception):
+                    raise item
+                batch, event = item
+                if event is not None:
+                    current_stream = torch.cuda.current_stream(self.device)
+                    current_stream.wait_event(event)
+                    # Tell the caching allocator these tensors are now used on the compute stream
+                    map_tensors(batch, lambda tensor: tensor.record_stream(current_stream))
+                yield batch
+        finally:
+            # Unblock the producer if iteration stopped early
+            stop.set()
+            while thread.is_alive():
+                try:
+                    ready.get(timeout=0.1)
+                except queue.Empty:
+                    pass
+
+
+class DeviceMetrics:
+    """Running loss and confusion matrix of a training epoch, kept on the training device.
+
+    update() only enqueues device ops, so a step never waits for the device to catch up
+    and no per-sample Python objects are created. snapshot() starts a non-blocking copy
+    of the running loss to the host and poll() returns it once the copy has landed, which
+    keeps the progress bar from stalling the pipeline. flush() syncs once, at epoch end.
+    """
+    def __init__(self, num_classes, device):
+        self.num_classes = num_classes
+        self.device = torch.device(device)
+        self.loss_sum = torch.zeros((), dtype=torch.float64, device=self.device)
+        self.confusion = torch.zeros(num_classes * num_classes, dtype=torch.int64, device=self.device)
+        self.num_batches = 0
+        self._pending = None
+
+    def update(self, loss, preds, labels):
+        self.loss_sum += loss.detach()
+        # index_add_ instead of bincount, which reads the largest index back to the host on CUDA
+        self.confusion.index_add_(0, labels * self.num_classes + preds, torch.ones_like(preds))
+        self.num_batches += 1
+
+    def snapshot(self):
+        if self.device.type == 'cuda':
+            loss_sum = torch.empty((), dtype=torch.float64, pin_memory=True)
+            loss_sum.copy_(self.loss_sum, non_blocking=True)
+            event = torch.cuda.Event()
+            event.record()
+        else:
+            loss_sum, event = self.loss_sum.clone(), None
+        self._pending = (loss_sum, event, self.num_batches)
+
+    def poll(self):
+        """Mean loss as of the last snapshot, None if there is none or its copy is still in flight."""
+        if self._pending is None:
+            return None
+        loss_sum, event, num_batches = self._pending
+        if event is not None and not event.query():
+            return None
+        self._pending = None
+        return loss_sum.item() / num_batches
+
+    def flush(self):
+        """Mean loss and the (true, predicted) confusion matrix on the host."""
+        confusion = self.confusion.view(self.num_classes, self.num_classes).cpu().numpy()
+        return self.loss_sum.item() / max(self.num_batches, 1), confusion
+
+    def state_dict(self):
+        return {'loss_sum': self.loss_sum.cpu(), 'confusion': self.confusion.cpu(), 'num_batches': self.num_batches}
+
+    def load_state_dict(self, state):
+        self.loss_sum.copy_(state['loss_sum'])
+        self.confusion.copy_(state['confusion'])
+        self.num_batches = state['num_batches']
+
+
+class ConfusionMatrix:
+    """Streaming (true, predicted) confusion matrix and the metrics derived from it.
+
+    update() adds a batch with one bincount, merge() adds the counts of another matrix,
+    e.g. one built in another process, and metrics() computes kappa, accuracy and the
+    weighted and per-class precision/recall from the counts alone. Like sklearn, the
+    metrics only cover the classes present in the labels or predictions, so the quadratic
+    kappa weights and the per-class arrays line up with cohen_kappa_score, precision_score
+    and recall_score on the same samples.
+    """
+    def __init__(self, num_classes=num_classes, counts=None):
+        self.num_classes = num_classes
+        if counts is None:
+            counts = np.zeros((num_classes, num_classes), dtype=np.int64)
+        self.counts = np.asarray(counts, dtype=np.int64).reshape(num_classes, num_classes)
+
+    @classmethod
+    def from_labels(cls, preds, labels, num_classes=num_classes):
+        return cls(num_classes).update(preds, labels)
+
+    def update(self, preds, labels):
+        preds = np.asarray(preds, dtype=np.int64).ravel()
+        labels = np.asarray(labels, dtype=np.int64).ravel()
+        self.counts += np.bincount(labels * self.num_classes + preds,
+                                   minlength=self.num_classes * self.num_classes).reshape(self.counts.shape)
+        return self
+
+    def merge(self, other):
+        self.counts += other.counts
+        return self
+
+    def metrics(self, per_class=False):
+        present = (self.counts.sum(axis=0) + self.counts.sum(axis=1)) > 0
+        confusion = self.counts[np.ix_(present, present)]
+
+        kappa = self._quadratic_kappa(confusion)
+        accuracy = float(np.trace(confusion) / confusion.sum()) if confusion.size else 0.0
+
+        true_positives = np.diag(confusion)
+        true_sum = confusion.sum(axis=1)
+        pred_sum = confusion.sum(axis=0)
+        # zero_division=0 for classes that are never predicted or never present
+        precision_per_class = np.divide(true_positives, pred_sum, out=np.zeros(len(confusion)), where=pred_sum != 0)
+        recall_per_class = np.divide(true_positives, true_sum, out=np.zeros(len(confusion)), where=true_sum != 0)
+        if true_sum.sum() == 0:
+            precision = recall = 0.0
+        else:
+            precision = float(np.average(precision_per_class, weights=true_sum))
+            recall = float(np.average(recall_per_class, weights=true_sum))
+
+        if per_class:
+            return kappa, accuracy, precision, recall, precision_per_class, recall_per_class
+        return kappa, accuracy, precision, recall
+
+    @staticmethod
+    def _quadratic_kappa(confusion):
+        # Same operations as cohen_kappa_score(labels, preds, weights='quadratic'), for identical results
+        confusion = confusion.astype(np.float64)
+        sum0 = confusion.sum(axis=0)
+        sum1 = confusion.sum(axis=1)
+        denominator = sum0.sum()
+        if denominator == 0:
+            return np.nan
+        expected = np.outer(sum0, sum1) / denominator
+        weights = np.zeros(confusion.shape) + np.arange(len(confusion))
+        weights = (weights - weights.T) ** 2
+        denominator = np.sum(weights * expected)
+        if denominator == 0:
+            return np.nan
+        return float(1 - np.sum(weights * confusion) / denominator)
+
+
+class MixedPrecision:
+    """Autocast context and loss scaling shared by train_model and evaluate_model.
+
+    float16 gradients underflow without loss scaling, so it gets a GradScaler; bfloat16
+    has the float32 exponent range and runs unscaled. Disabled, autocast() is a no-op
+    and step() is a plain backward and optimizer step.
+    """
+    def __init__(self, device, dtype='bfloat16', enabled=True):
+        self.device_type = torch.device(device).type
+        self.dtype = getattr(torch, dtype)
+        self.enabled = enabled
+        self.scaler = None
+        if enabled and self.dtype == torch.float16:
+            if self.device_type != 'cuda':
+                raise ValueError('float16 autocast needs CUDA, use bfloat16 on CPU')
+            # torch.amp.GradScaler is new in torch 2.3, older releases only have the CUDA one
+            if hasattr(getattr(torch, 'amp', None), 'GradScaler'):
+                self.scaler = torch.amp.GradScaler('cuda')
+            else:
+                self.scaler = torch.cuda.amp.GradScaler()
+
+    @property
+    def name(self):
+        return str(self.dtype).replace('torch.', '') if self.enabled else 'float32'
+
+    def autocast(self):
+        return torch.autocast(self.device_type, dtype=self.dtype, enabled=self.enabled)
+
+    def step(self, loss, optimizer):
+        if self.scaler is None:
+            loss.backward()
+            optimizer.step()
+            return
+        self.scaler.scale(loss).backward()
+        self.scaler.step(optimizer)
+        self.scaler.update()
+
+    def state_dict(self):
+        return self.scaler.state_dict() if self.scaler is not None else {}
+
+    def load_state_dict(self, state):
+        if self.scaler is not None and state:
+            self.scaler.load_state_dict(state)
+
+
+def update_precision_report(report_path, row):
+    """Add or replace the row of one run and precision, print all precisions of that run."""
+    os.makedirs(os.path.dirname(report_path) or '.', exist_ok=True)
+    report = pd.read_csv(report_path) if os.path.exists(report_path) else pd.DataFrame(columns=list(row))
+    same_run = (report['run_id'] == row['run_id']) & (report['precision'] == row['precision'])
+    report = pd.concat([report[~same_run], pd.DataFrame([row])], ignore_index=True)
+    report.to_csv(report_path, index=False)
+    print(f"\nPrecision comparison for {row['run_id']}:")
+    print(report[report['run_id'] == row['run_id']].drop(columns='run_id').to_string(index=False))
+
+
+def rng_state():
+    """States of every random number generator training draws from."""
+    return {
+        'python': random.getstate(),
+        'numpy': np.random.get_state(),
+        'torch': torch.get_rng_state(),
+        'cuda': torch.cuda.get_rng_state_all() if torch.cuda.is_available() else []
+    }
+
+
+def set_rng_state(state):
+    random.setstate(state['python'])
+    np.random.set_state(state['numpy'])
+    torch.set_rng_state(state['torch'])
+    if state['cuda'] and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state['cuda'])
+
+
+class CheckpointManager:
+    """Writes training checkpoints on a background thread, keeping the last-K and best-K epochs.
+
+    save() copies the model and optimizer tensors into CPU buffers allocated on the first
+    call (pinned and non-blocking on CUDA), then serializes them on a writer thread while
+    training continues. The best model has its own buffers, so best_model_state is the
+    in-memory best copy without a deepcopy per improvement. Every checkpoint is written to
+    a temporary file and renamed into place, so an interrupted write never leaves a partial
+    file. Epoch files are <checkpoint stem>_epochNNN.pth and checkpoint_path links to the
+    best one. Call wait() before reading the files or exiting.
+
+    save_resume() writes the full training state to <checkpoint stem>_resume.pth the same
+    way, and load_resume() reads it back together with the best model and the epoch files
+    kept so far, so a restarted run continues where the last one stopped. A resume file saved
+    with a different run_config belongs to another run and is ignored.
+    """
+    def __init__(self, checkpoint_path, keep_last=1, keep_best=1, device='cpu'):
+        self.checkpoint_path = checkpoint_path
+        self.keep_last = keep_last
+        self.keep_best = max(keep_best, 1)
+        self.pin_memory = torch.device(device).type == 'cuda'
+        self.best_metric = None
+        self.best_model_state = None
+        self._last = []  # epochs, oldest first
+        self._best = []  # (metric, epoch), best first
+        self._buffers = {'best': {}, 'last': {}, 'optimizer': {}}
+        self._thread = None
+        self._error = None
+
+    def epoch_path(self, epoch):
+        stem, ext = os.path.splitext(self.checkpoint_path)
+        return f'{stem}_epoch{epoch:03d}{ext}'
+
+    @property
+    def resume_path(self):
+        stem, ext = os.path.splitext(self.checkpoint_path)
+        return f'{stem}_resume{ext}'
+
+    def save(self, epoch, model, optimizer, metric, **extra):
+        """Snapshot and queue the checkpoint of an epoch, returns whether metric is a new best."""
+        is_best = self.best_metric is None or metric > self.best_metric
+        in_best = len(self._best) < self.keep_best or metric > self._best[-1][0]
+        if not (in_best or self.keep_last):
+            return False
+
+        # The previous write still reads the snapshot buffers
+        self.wait()
+        if is_best:
+            self.best_metric = metric
+            self.best_model_state = self._snapshot(model.state_dict(), self._buffers['best'])
+            model_state = self.best_model_state
+        else:
+            model_state = self._snapshot(model.state_dict(), self._buffers['last'])
+        checkpoint = {
+            'epoch': epoch,
+            'model_state_dict': model_state,
+            'optimizer_state_dict': self._snapshot(optimizer.state_dict(), self._buffers['optimizer']),
+            **copy.deepcopy(extra)
+        }
+        event = None
+        if self.pin_memory:
+            event = torch.cuda.Event()
+            event.record()
+
+        kept_before = set(self._last) | {e for _, e in self._best}
+        if self.keep_last:
+            self._last = (self._last + [epoch])[-self.keep_last:]
+        if in_best:
+            self._best = sorted(self._best + [(metric, epoch)], key=lambda item: -item[0])[:self.keep_best]
+        kept = set(self._last) | {e for _, e in self._best}
+        stale = [self.epoch_path(e) for e in kept_before - kept]
+
+        self._start_write(checkpoint, event, self.epoch_path(epoch), link_best=is_best, stale=stale)
+        return is_best
+
+    def save_resume(self, model, optimizer, **state):
+        """Snapshot and queue the resume checkpoint, state holds everything besides the model and optimizer."""
+        self.wait()
+        checkpoint = {
+            'model_state_dict': self._snapshot(model.state_dict(), self._buffers['last']),
+            'optimizer_state_dict': self._snapshot(optimizer.state_dict(), self._buffers['optimizer']),
+            'checkpoints': {'best_metric': self.best_metric, 'last': self._last, 'best': self._best},
+            **copy.deepcopy(state)
+        }
+        event = None
+        if self.pin_memory:
+            event = torch.cuda.Event()
+            event.record()
+        self._start_write(checkpoint, event, self.resume_path)
+
+    def load_resume(self, run_config=None):
+        """The last resume checkpoint, None if there is none. Restores best_model_state and the kept epochs."""
+        if not os.path.exists(self.resume_path):
+            return None
+        state = torch.load(self.resume_path, map_location='cpu', weights_only=False)
+        if state.get('run_config') != run_config:
+            print(f'Ignoring {self.resume_path}, it was saved with a different configuration')
+            return None
+        kept = state.pop('checkpoints')
+        self.best_metric, self._last, self._best = kept['best_metric'], kept['last'], kept['best']
+        if self.best_metric is not None:
+            best = torch.load(self.checkpoint_path, map_location='cpu', weights_only=False)
+            self.best_model_state = self._snapshot(best['model_state_dict'], self._buffers['best'])
+        return state
+
+    def remove_resume(self):
+        self.wait()
+        if os.path.exists(self.resume_path):
+            os.remove(self.resume_path)
+
+    def wait(self):
+        """Block until the queued checkpoint is on disk, re-raising a failed write."""
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise error
+
+    def _snapshot(self, state, buffers, key=()):
+        if torch.is_tensor(state):
+            buffer = buffers.get(key)
+            if buffer is None or buffer.shape != state.shape or buffer.dtype != state.dtype:
+                buffer = torch.empty(state.shape, dtype=state.dtype, pin_memory=self.pin_memory)
+                buffers[key] = buffer
+            buffer.copy_(state.detach(), non_blocking=self.pin_memory)
+            return buffer
+        if isinstance(state, dict):
+            return {k: self._snapshot(v, buffers, key + (k,)) for k, v in state.items()}
+        if isinstance(state, (list, tuple)):
+            return type(state)(self._snapshot(v, buffers, key + (i,)) for i, v in enumerate(state))
+        return state
+
+    def _start_write(self, checkpoint, event, path, link_best=False, stale=()):
+        self._thread = threading.Thread(target=self._write, args=(checkpoint, event, path, link_best, stale),
+                                        daemon=True)
+        self._thread.start()
+
+    def _write(self, checkpoint, event, path, link_best, stale):
+        try:
+            if event is not None:
+                event.synchronize()
+            os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+            tmp_path = f'{path}.tmp'
+            torch.save(checkpoint, tmp_path)
+            os.replace(tmp_path, path)
+            if link_best:
+                tmp_path = f'{self.checkpoint_path}.tmp'
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+                try:
+                    os.link(path, tmp_path)
+                except OSError:
+                    shutil.copyfile(path, tmp_path)
+                os.replace(tmp_path, self.checkpoint_path)
+            for stale_path in stale:
+                if os.path.exists(stale_path):
+                    os.remove(stale_path)
+        except Exception as e:
+            self._error = e
+
 
 def train_model(model, train_loader, val_loader, device, criterion, optimizer, lr_scheduler, num_epochs=25,
-                checkpoint_path='model.pth'):
-    best_model_state = None
-    best_val_kappa = -1.0
+                checkpoint_path='model.pth', batch_transform=None, prefetch_batches=0, eval_batch_transform=None,
+                memory_report=False, amp=None, sync_interval=50, checkpoints=None, resume=False, resume_interval=0,
+                run_config=None):
+    amp = amp or MixedPrecision(device, enabled=False)
+    checkpoints = checkpoints or CheckpointManager(checkpoint_path, device=device)
+    sampler = train_loader.sampler if isinstance(train_loader.sampler, ResumableSampler) else None
     training_history = {
         'train_loss': [],
         'val_loss': [],
@@ -283,49 +1895,106 @@ def train_model(model, train_loader, val_loader, device, criterion, optimizer, l
         'val_accuracy': [],
         'train_kappa': [],
         'val_kappa': [],
-        'learning_rates': []
+        'learning_rates': [],
+        'train_images_per_sec': [],
+        'val_images_per_sec': []
     }
-    
-    for epoch in range(1, num_epochs + 1):
+    memory = WorkerMemoryReport(train_loader) if memory_report else None
+
+    def save_resume(epoch, batch_index, metrics=None):
+        # Resuming part way through an epoch needs the sampler order, so without a
+        # ResumableSampler only epoch boundaries are resumable
+        checkpoints.save_resume(
+            model, optimizer,
+            epoch=epoch,
+            batch_index=batch_index,
+            scheduler_state_dict=lr_scheduler.state_dict(),
+            scaler_state_dict=amp.state_dict(),
+            training_history=training_history,
+            rng_state=rng_state(),
+            sampler_state=sampler.state_dict(batch_index * train_loader.batch_size) if sampler else None,
+            metrics_state=metrics.state_dict() if metrics is not None else None,
+            run_config=run_config
+        )
+
+    start_epoch, start_batch, resume_state = 1, 0, None
+    if resume:
+        resume_state = checkpoints.load_resume(run_config)
+    if resume_state is not None:
+        model.load_state_dict(resume_state['model_state_dict'])
+        optimizer.load_state_dict(resume_state['optimizer_state_dict'])
+        lr_scheduler.load_state_dict(resume_state['scheduler_state_dict'])
+        amp.load_state_dict(resume_state['scaler_state_dict'])
+        training_history = resume_state['training_history']
+        set_rng_state(resume_state['rng_state'])
+        start_epoch, start_batch = resume_state['epoch'], resume_state['batch_index']
+        if sampler is not None and resume_state['sampler_state'] is not None:
+            sampler.load_state_dict(resume_state['sampler_state'])
+        elif start_batch:
+            print(f'Train loader has no ResumableSampler, restarting epoch {start_epoch} from its first batch')
+            start_batch = 0
+        print(f'Resuming from {checkpoints.resume_path} at epoch {start_epoch}, batch {start_batch}')
+
+    for epoch in range(start_epoch, num_epochs + 1):
         print(f'\nEpoch {epoch}/{num_epochs}')
         model.train()
-        running_loss = []
-        all_preds = []
-        all_labels = []
+        metrics = DeviceMetrics(num_classes, device)
+        if epoch == start_epoch and start_batch and resume_state['metrics_state'] is not None:
+            metrics.load_state_dict(resume_state['metrics_state'])
+        first_batch = start_batch if epoch == start_epoch else 0
+        num_images = 0
+        epoch_start = time.perf_counter()
 
-        with tqdm(total=len(train_loader), desc=f'Training', unit=' batch') as pbar:
-            for batch_idx, (images, labels) in enumerate(train_loader):
+        batches = BatchPrefetcher(train_loader, device, prefetch_batches) if prefetch_batches > 0 else train_loader
+
+        with tqdm(total=len(train_loader), initial=first_batch, desc=f'Training', unit=' batch') as pbar:
+            for batch_idx, (images, labels) in enumerate(batches, first_batch):
                 try:
                     if isinstance(images, (list, tuple)):
                         images = [img.to(device) for img in images]
                     else:
                         images = images.to(device)
                     labels = labels.to(device)
+                    if batch_transform is not None:
+                        images = batch_transform(images)
 
                     optimizer.zero_grad()
-                    outputs = model(images)
+                    with amp.autocast():
+                        outputs = model(images)
+                    # Loss and metrics in float32 whatever the autocast dtype
+                    outputs = outputs.float()
                     loss = criterion(outputs, labels)
-                    loss.backward()
-                    optimizer.step()
+                    amp.step(loss, optimizer)
 
                     preds = torch.argmax(outputs, 1)
-                    running_loss.append(loss.item())
-                    all_preds.extend(preds.cpu().numpy())
-                    all_labels.extend(labels.cpu().numpy())
-
-                    pbar.set_postfix({
-                        'loss': f'{loss.item():.4f}',
-                        'lr': f'{optimizer.param_groups[0]["lr"]:.1e}'
-                    })
+                    num_images += labels.size(0)
+                    metrics.update(loss, preds, labels)
+
+                    if metrics.num_batches % sync_interval == 0:
+                        metrics.snapshot()
+                    running_loss = metrics.poll()
+                    if running_loss is not None:
+                        pbar.set_postfix({
+                            'loss': f'{running_loss:.4f}',
+                            'lr': f'{optimizer.param_groups[0]["lr"]:.1e}'
+                        })
                     pbar.update(1)
 
+                    if resume and resume_interval and (batch_idx + 1) % resume_interval == 0 \
+                            and batch_idx + 1 < len(train_loader):
+                        save_resume(epoch, batch_idx + 1, metrics)
+
                 except Exception as e:
                     print(f"Error in batch {batch_idx}: {str(e)}")
                     continue
 
+        epoch_loss, confusion = metrics.flush()
+        training_history['train_images_per_sec'].append(num_images / (time.perf_counter() - epoch_start))
+        if memory is not None:
+            memory.record(epoch)
+
         # Calculate training metrics
-        epoch_loss = np.mean(running_loss)
-        train_metrics = compute_metrics(all_preds, all_labels)
+        train_metrics = ConfusionMatrix(num_classes, confusion).metrics()
         training_history['train_loss'].append(epoch_loss)
         training_history['train_accuracy'].append(train_metrics[1])
         training_history['train_kappa'].append(train_metrics[0])
@@ -333,7 +2002,9 @@ def train_model(model, train_loader, val_loader, device, criterion, optimizer, l
 
         # Validation phase
         model.eval()
-        val_metrics = evaluate_model(model, val_loader, device)
+        val_start = time.perf_counter()
+        val_metrics = evaluate_model(model, val_loader, device, batch_transform=eval_batch_transform, amp=amp)
+        training_history['val_images_per_sec'].append(len(val_loader.dataset) / (time.perf_counter() - val_start))
         val_kappa = val_metrics[0]
         
         # Update validation history
@@ -349,20 +2020,17 @@ def train_model(model, train_loader, val_loader, device, criterion, optimizer, l
         # Step the scheduler with validation kappa score
         lr_scheduler.step(val_kappa)
 
-        if val_kappa > best_val_kappa:
-            best_val_kappa = val_kappa
-            best_model_state = copy.deepcopy(model.state_dict())
-            torch.save({
-                'epoch': epoch,
-                'model_state_dict': model.state_dict(),
-                'optimizer_state_dict': optimizer.state_dict(),
-                'best_val_kappa': best_val_kappa,
-                'training_history': training_history
-            }, checkpoint_path)
-            print(f'Saved new best model with validation kappa: {val_kappa:.4f}')
+        if checkpoints.save(epoch, model, optimizer, val_kappa, best_val_kappa=max(training_history['val_kappa']),
+                            precision=amp.name, training_history=training_history):
+            print(f'Saving new best model with validation kappa: {val_kappa:.4f}')
+        if resume:
+            save_resume(epoch + 1, 0)
 
+    checkpoints.wait()
+    if resume:
+        checkpoints.remove_resume()
     # Load best model
-    model.load_state_dict(best_model_state)
+    model.load_state_dict(checkpoints.best_model_state)
     return model, training_history
 
 
@@ -370,12 +2038,13 @@ def train_model(model, train_loader, val_loader, device, criterion, optimizer, l
 
 
 
-def evaluate_model(model, test_loader, device, test_only=False, prediction_path='./test_predictions.csv'):
+def evaluate_model(model, test_loader, device, test_only=False, prediction_path='./test_predictions.csv',
+                   batch_transform=None, amp=None):
     model.eval()
 
     all_preds = []
-    all_labels = []
     all_image_ids = []
+    confusion = ConfusionMatrix(num_classes)
 
     with tqdm(total=len(test_loader), desc=f'Evaluating', unit=' batch', file=sys.stdout) as pbar:
         for i, data in enumerate(test_loader):
@@ -389,32 +2058,41 @@ def evaluate_model(model, test_loader, device, test_only=False, prediction_path=
                 images = images.to(device)  # single image case
             else:
                 images = [x.to(device) for x in images]  # dual images case
+            if batch_transform is not None:
+                images = batch_transform(images)
 
             with torch.no_grad():
-                outputs = model(images)
-                preds = torch.argmax(outputs, 1)
+                if amp is not None:
+                    with amp.autocast():
+                        outputs = model(images)
+                else:
+                    outputs = model(images)
+                preds = torch.argmax(outputs.float(), 1)
 
+            preds = preds.cpu().numpy()
             if not isinstance(images, list):
                 # single image case
-                all_preds.extend(preds.cpu().numpy())
-                image_ids = [
-                    os.path.basename(test_loader.dataset.data[idx]['img_path']) for idx in
-                    range(i * test_loader.batch_size, i * test_loader.batch_size + len(images))
-                ]
-                all_image_ids.extend(image_ids)
-                if not test_only:
-                    all_labels.extend(labels.numpy())
-            else:
-                # dual images case
-                for k in range(2):
-                    all_preds.extend(preds.cpu().numpy())
+                if test_only:
+                    all_preds.extend(preds)
                     image_ids = [
-                        os.path.basename(test_loader.dataset.data[idx][f'img_path{k + 1}']) for idx in
-                        range(i * test_loader.batch_size, i * test_loader.batch_size + len(images[k]))
+                        test_loader.dataset.data[idx]['image_name'] for idx in
+                        range(i * test_loader.batch_size, i * test_loader.batch_size + len(images))
                     ]
                     all_image_ids.extend(image_ids)
-                    if not test_only:
-                        all_labels.extend(labels.numpy())
+                else:
+                    confusion.update(preds, labels.numpy())
+            else:
+                # dual images case, each pair counts once per image
+                for k in range(2):
+                    if test_only:
+                        all_preds.extend(preds)
+                        image_ids = [
+                            test_loader.dataset.data[idx][f'image_name{k + 1}'] for idx in
+                            range(i * test_loader.batch_size, i * test_loader.batch_size + len(images[k]))
+                        ]
+                        all_image_ids.extend(image_ids)
+                    else:
+                        confusion.update(preds, labels.numpy())
 
             pbar.update(1)
 
@@ -427,23 +2105,12 @@ def evaluate_model(model, test_loader, device, test_only=False, prediction_path=
         df.to_csv(prediction_path, index=False)
         print(f'[Test] Save predictions to {os.path.abspath(prediction_path)}')
     else:
-        metrics = compute_metrics(all_preds, all_labels)
+        metrics = confusion.metrics()
         return metrics
 
 
 def compute_metrics(preds, labels, per_class=False):
-    kappa = cohen_kappa_score(labels, preds, weights='quadratic')
-    accuracy = accuracy_score(labels, preds)
-    precision = precision_score(labels, preds, average='weighted', zero_division=0)
-    recall = recall_score(labels, preds, average='weighted', zero_division=0)
-
-    # Calculate and print precision and recall for each class
-    if per_class:
-        precision_per_class = precision_score(labels, preds, average=None, zero_division=0)
-        recall_per_class = recall_score(labels, preds, average=None, zero_division=0)
-        return kappa, accuracy, precision, recall, precision_per_class, recall_per_class
-
-    return kappa, accuracy, precision, recall
+    return ConfusionMatrix.from_labels(preds, labels).metrics(per_class=per_class)
 
 
 class SpatialAttention(nn.Module):
@@ -453,7 +2120,8 @@ class SpatialAttention(nn.Module):
         self.sigmoid = nn.Sigmoid()
 
     def forward(self, x):
-        avg_out = torch.mean(x, dim=1, keepdim=True)  # Average pooling along channel axis
+        # Channel mean accumulated in float32, a 512-term bfloat16/float16 sum loses precision
+        avg_out = torch.mean(x, dim=1, keepdim=True, dtype=torch.float32).to(x.dtype)  # Average pooling along channel axis
         max_out, _ = torch.max(x, dim=1, keepdim=True)  # Max pooling along channel axis
         x = torch.cat([avg_out, max_out], dim=1)  # Concatenate along channel axis
         x = self.conv(x)  # Learn spatial importance
@@ -480,7 +2148,8 @@ class SelfAttention(nn.Module):
         value = self.value_conv(x).view(batch_size, -1, H * W)  # (B, H*W, C)
 
         energy = torch.bmm(query, key)  # (B, H*W, H*W)
-        attention = torch.softmax(energy, dim=-1)  # (B, H*W, H*W)
+        # Softmax in float32, half-precision energies overflow exp() under autocast
+        attention = torch.softmax(energy.float(), dim=-1).to(value.dtype)  # (B, H*W, H*W)
 
         out = torch.bmm(value, attention.permute(0, 2, 1))  # (B, C, H*W)
         out = out.view(batch_size, C, H, W)  # (B, C, H, W)
@@ -611,7 +2280,7 @@ class EnsembleModel(nn.Module):
             if self.ensemble_methods.get('max_voting', False):
                 # Weighted voting using softmax probabilities
                 weighted_probs = stacked_probs * F.softmax(self.model_weights.view(-1, 1, 1), dim=0)
-                final_probs = weighted_probs.sum(dim=0)
+                final_probs = weighted_probs.float().sum(dim=0)
                 return torch.log(final_probs + 1e-8)  # Add small epsilon to prevent log(0)
             
             elif self.ensemble_methods.get('stacking', False):
@@ -623,34 +2292,127 @@ class EnsembleModel(nn.Module):
             else:  # Default to average
                 return torch.mean(stacked_outputs, dim=0)
         
-def create_data_loaders(train_dataset, val_dataset, test_dataset, batch_size):
-    # Create DataLoaders with proper worker initialization
-    train_loader = DataLoader(
+def seed_worker(worker_id):
+    """Seed Python and NumPy RNGs of a DataLoader worker process.
+
+    torch seeds every worker with base_seed + worker_id, where base_seed is drawn from the
+    loader's generator whenever worker processes are started. SLORandomPad and FundRandomRotate
+    use `random` and CutOut uses NumPy, which torch leaves alone, so derive their seeds from the
+    torch seed to get distinct, reproducible streams per worker. With persistent_workers (the
+    default) the workers start once per run, so this runs once and every worker continues the
+    same streams across epochs; without it the workers and their seeds are renewed every epoch.
+    """
+    worker_seed = torch.initial_seed() % 2 ** 32
+    np.random.seed(worker_seed)
+    random.seed(worker_seed)
+
+
+class ThreadBudget:
+    """Splits the available cores between the training process and DataLoader workers.
+
+    OpenCV and torch each default to one thread per core in every process, so N workers plus
+    the training process would run (N + 1) x 2 thread pools on the same cores. Workers get an
+    equal share of the cores, the training process keeps one on GPU (it mostly launches
+    kernels) and the remainder on CPU. OpenCV only runs in the training process when there are
+    no workers.
+    """
+    def __init__(self, num_workers, device=None, cpu_threads=None):
+        if cpu_threads is None:
+            cpu_threads = len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else os.cpu_count() or 1
+        self.cpu_threads = cpu_threads
+        self.num_workers = num_workers
+        if num_workers == 0:
+            self.main_threads = cpu_threads
+            self.main_cv2_threads = cpu_threads
+            self.worker_threads = 0
+        else:
+            on_gpu = device is not None and torch.device(device).type == 'cuda'
+            self.main_threads = 1 if on_gpu else max(1, cpu_threads - num_workers)
+            self.main_cv2_threads = 1
+            self.worker_threads = max(1, (cpu_threads - self.main_threads) // num_workers)
+
+    def configure_main_process(self):
+        torch.set_num_threads(self.main_threads)
+        cv2.setNumThreads(self.main_cv2_threads)
+
+    def worker_init_fn(self):
+        return functools.partial(init_worker, num_threads=self.worker_threads)
+
+    def report(self):
+        print(f"Thread budget: {self.cpu_threads} cores, main process {self.main_threads} torch / "
+              f"{self.main_cv2_threads} OpenCV threads, {self.num_workers} workers x "
+              f"{self.worker_threads} torch / OpenCV threads")
+
+
+def init_worker(worker_id, num_threads=1):
+    """worker_init_fn applying the ThreadBudget share of a DataLoader worker before seeding it."""
+    torch.set_num_threads(num_threads)
+    cv2.setNumThreads(num_threads)
+    seed_worker(worker_id)
+
+
+def data_loader_kwargs(loader_config, seed_offset=0, thread_budget=None):
+    num_workers = loader_config['num_workers']
+    kwargs = {
+        'num_workers': num_workers,
+        'pin_memory': True
+    }
+    if num_workers > 0:
+        thread_budget = thread_budget or ThreadBudget(num_workers, cpu_threads=loader_config.get('cpu_threads'))
+        kwargs['worker_init_fn'] = thread_budget.worker_init_fn()
+        kwargs['persistent_workers'] = loader_config['persistent_workers']
+        kwargs['prefetch_factor'] = loader_config['prefetch_factor']
+    if loader_config.get('uint8_batches', False):
+        kwargs['collate_fn'] = collate_uint8
+    if loader_config['reproducible']:
+        kwargs['generator'] = torch.Generator().manual_seed(loader_config['seed'] + seed_offset)
+    return kwargs
+
+
+def create_data_loaders(train_dataset, val_dataset, test_dataset, batch_size, loader_config=None, thread_budget=None):
+    loader_config = loader_config or CONFIG['data_loader']
+
+    train_kwargs = data_loader_kwargs(loader_config, seed_offset=0, thread_budget=thread_budget)
+    if 'generator' not in train_kwargs:
+        train_kwargs['generator'] = torch.Generator()
+        train_kwargs['generator'].seed()
+    # The training order comes from one generator so resumed runs can redraw it
+    generator = train_kwargs['generator']
+    if loader_config.get('oversampling', False):
+        sampler = DynamicOversampler(train_dataset.labels, generator=generator)
+    else:
+        sampler = RandomSampler(train_dataset, generator=generator)
+    train_kwargs['sampler'] = ResumableSampler(sampler, generator)
+
+    train_loader = ResumableDataLoader(
         train_dataset, 
         batch_size=batch_size,
-        shuffle=True,
-        num_workers=0,  # Set to 0 to avoid multiprocessing issues
-        pin_memory=True
+        **train_kwargs
     )
     
     val_loader = DataLoader(
         val_dataset,
         batch_size=batch_size,
         shuffle=False,
-        num_workers=0,
-        pin_memory=True
+        **data_loader_kwargs(loader_config, seed_offset=1, thread_budget=thread_budget)
     )
     
     test_loader = DataLoader(
         test_dataset,
         batch_size=batch_size,
         shuffle=False,
-        num_workers=0,
-        pin_memory=True
+        **data_loader_kwargs(loader_config, seed_offset=2, thread_budget=thread_budget)
     )
     
     return train_loader, val_loader, test_loader
 
+def split_files(split, materialized_dir=None):
+    """Annotation file and image directory of a DeepDRiD split, or of its materialized copy."""
+    if materialized_dir is not None:
+        return os.path.join(materialized_dir, f'{split}.csv'), os.path.join(materialized_dir, split, '')
+    return f'./DeepDRiD/{split}.csv', f'./DeepDRiD/{split}/'
+
+
 def main():
     # Set device and seed for reproducibility
     device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
@@ -663,35 +2425,79 @@ def main():
     random.seed(42)
     
     print(f"Using device: {device}")
+
+    loader_config = CONFIG['data_loader']
+    thread_budget = ThreadBudget(loader_config['num_workers'], device=device, cpu_threads=loader_config['cpu_threads'])
+    thread_budget.configure_main_process()
+    thread_budget.report()
     
     # Create datasets with selected preprocessing
     preprocessing_config = CONFIG['preprocessing']
+    preprocessing_options = CONFIG['preprocessing_options']
+    cache_config = CONFIG['preprocessing_cache']
+    packed_dir = CONFIG['packed_dataset']['packed_dir'] if CONFIG['packed_dataset']['enabled'] else None
+    decode_size = CONFIG['decoding']['decode_size']
+
+    materialized_dir = None
+    dataset_preprocessing = preprocessing_config
+    if CONFIG['materialized_preprocessing']['enabled']:
+        if packed_dir is not None:
+            raise ValueError('Enable either the packed dataset or materialized preprocessing, not both')
+        # Images were already preprocessed offline by materialize_preprocessing.py
+        materialized_dir = os.path.join(
+            CONFIG['materialized_preprocessing']['materialized_dir'],
+            preprocessing_config_name(preprocessing_config)
+        )
+        dataset_preprocessing = None
+        if CONFIG['roi_crop']['enabled']:
+            raise ValueError('Materialized images are already preprocessed, retina cropping needs the source images')
     
+    uint8_batches = CONFIG['data_loader']['uint8_batches']
+    train_transform, batch_transform = train_transforms(CONFIG['augmentation'], uint8=uint8_batches)
+    eval_transform = transform_test_uint8 if uint8_batches else transform_test
+    eval_batch_transform = NormalizeBatch() if uint8_batches else None
     train_dataset = RetinopathyDataset(
-        './DeepDRiD/train.csv',
-        './DeepDRiD/train/',
-        transform_train,
-        preprocessing_config=preprocessing_config
+        *split_files('train', materialized_dir),
+        train_transform,
+        preprocessing_config=dataset_preprocessing,
+        preprocessing_options=preprocessing_options,
+        cache_config=cache_config,
+        packed_dir=packed_dir,
+        split='train',
+        decode_size=decode_size,
+        image_cache_config=CONFIG['image_cache'],
+        roi_config=CONFIG['roi_crop']
     )
     
     val_dataset = RetinopathyDataset(
-        './DeepDRiD/val.csv',
-        './DeepDRiD/val/',
-        transform_test,
-        preprocessing_config=preprocessing_config
+        *split_files('val', materialized_dir),
+        eval_transform,
+        preprocessing_config=dataset_preprocessing,
+        preprocessing_options=preprocessing_options,
+        cache_config=cache_config,
+        packed_dir=packed_dir,
+        split='val',
+        decode_size=decode_size,
+        image_cache_config=CONFIG['image_cache'],
+        roi_config=CONFIG['roi_crop']
     )
     
     test_dataset = RetinopathyDataset(
-        './DeepDRiD/test.csv',
-        './DeepDRiD/test/',
-        transform_test,
-        preprocessing_config=preprocessing_config,
+        *split_files('test', materialized_dir),
+        eval_transform,
+        preprocessing_config=dataset_preprocessing,
+        preprocessing_options=preprocessing_options,
+        cache_config=cache_config,
+        packed_dir=packed_dir,
+        split='test',
+        decode_size=decode_size,
+        roi_config=CONFIG['roi_crop'],
         test=True
     )
     
     # Create dataloaders
     train_loader, val_loader, test_loader = create_data_loaders(
-        train_dataset, val_dataset, test_dataset, batch_size
+        train_dataset, val_dataset, test_dataset, batch_size, loader_config=loader_config, thread_budget=thread_budget
     )
     
     # Initialize models with different random seeds
@@ -757,25 +2563,56 @@ def main():
     # Train model
     checkpoint_path = f'checkpoints/model_{run_id}.pth'
     
+    amp = MixedPrecision(device, dtype=CONFIG['amp']['dtype'], enabled=CONFIG['amp']['enabled'])
+    print(f"Precision: {amp.name}")
+
+    # Settings that change the training run, the resume file of a run with other ones is not used
+    run_config = {key: CONFIG[key] for key in ('models', 'ensemble_methods', 'preprocessing', 'preprocessing_options',
+                                               'preprocessing_cache', 'materialized_preprocessing', 'packed_dataset',
+                                               'decoding', 'roi_crop', 'augmentation', 'amp')}
+    run_config['data_loader'] = {key: value for key, value in CONFIG['data_loader'].items()
+                                 if key not in ('device_prefetch', 'cpu_threads', 'memory_report')}
+    run_config.update(batch_size=batch_size, learning_rate=learning_rate, num_epochs=num_epochs)
+
     ensemble, training_history = train_model(
         ensemble, train_loader, val_loader, device,
         criterion, optimizer, lr_scheduler,
         num_epochs=num_epochs,
-        checkpoint_path=checkpoint_path
+        checkpoint_path=checkpoint_path,
+        batch_transform=batch_transform,
+        prefetch_batches=CONFIG['data_loader']['device_prefetch'],
+        eval_batch_transform=eval_batch_transform,
+        memory_report=CONFIG['data_loader']['memory_report'],
+        amp=amp,
+        sync_interval=CONFIG['training']['sync_interval'],
+        checkpoints=CheckpointManager(checkpoint_path, keep_last=CONFIG['checkpoints']['keep_last'],
+                                      keep_best=CONFIG['checkpoints']['keep_best'], device=device),
+        resume=CONFIG['checkpoints']['resume'],
+        resume_interval=CONFIG['checkpoints']['resume_interval'],
+        run_config=run_config
     )
+    update_precision_report(CONFIG['amp']['report_path'], {
+        'run_id': run_id,
+        'precision': amp.name,
+        'train_images_per_sec': np.mean(training_history['train_images_per_sec']),
+        'val_images_per_sec': np.mean(training_history['val_images_per_sec']),
+        'best_val_kappa': max(training_history['val_kappa'])
+    })
     
     # Generate predictions
     prediction_path = f'predictions/pred_{run_id}.csv'
     test_metrics = evaluate_model(
         ensemble, test_loader, device,
         test_only=True,
-        prediction_path=prediction_path
+        prediction_path=prediction_path,
+        batch_transform=eval_batch_transform,
+        amp=amp
     )
     
     # Save visualization results
     visualize_and_explain(
         model=ensemble,
-        dataloader=val_loader,
+        dataloader=TransformedBatches(val_loader, eval_batch_transform) if uint8_batches else val_loader,
         device=device,
         num_epochs=num_epochs,
         training_history=training_history,
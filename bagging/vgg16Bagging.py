@@ -11,16 +11,25 @@ import torch
 import torch.nn as nn
 from PIL import Image
 from sklearn.metrics import cohen_kappa_score, precision_score, recall_score, accuracy_score
-from torch.utils.data import Dataset, DataLoader
+from torch.utils.data import Dataset, DataLoader, RandomSampler
 from torchvision import models, transforms
 from torchvision.transforms.functional import to_pil_image, adjust_gamma
 from tqdm import tqdm
 import torch.nn.functional as F
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from aio import DeviceMetrics  # noqa: E402
+
 # Hyper Parameters
 batch_size = 24
 num_classes = 5  # 5 DR levels
 learning_rate = 0.0001
 num_epochs = 5
+num_workers = min(8, os.cpu_count() or 1)  # DataLoader worker processes, 0 loads in the main process
+prefetch_factor = 2  # Batches loaded in advance by each worker
+persistent_workers = True  # Keep workers alive between epochs instead of re-forking them
+reproducible = True  # Draw shuffling and worker seeds from fixed-seed generators
+sync_interval = 50  # Training steps between host reads of the running loss
 
 
 class RetinopathyDataset(Dataset):
@@ -182,22 +191,87 @@ transform_test = transforms.Compose([
 ])
 
 
+def resume_path_for(checkpoint_path):
+    stem, ext = os.path.splitext(checkpoint_path)
+    return f'{stem}_resume{ext}'
+
+
+def shuffle_generator(loader):
+    return getattr(loader.sampler, 'generator', None)
+
+
+def rng_state(loader):
+    return {
+        'python': random.getstate(),
+        'numpy': np.random.get_state(),
+        'torch': torch.get_rng_state(),
+        'cuda': torch.cuda.get_rng_state_all() if torch.cuda.is_available() else [],
+        'sampler': shuffle_generator(loader).get_state() if shuffle_generator(loader) is not None else None,
+        'loader': loader.generator.get_state() if loader.generator is not None else None,
+        'loader_seed': loader.generator.initial_seed() if loader.generator is not None else None
+    }
+
+
+def set_rng_state(state, loader):
+    # The sampler generator decides the shuffling order of every following epoch. The loader
+    # generator draws the workers' base seed whenever an iterator starts, which persistent
+    # workers do once per run, so a resumed run redraws that first seed
+    random.setstate(state['python'])
+    np.random.set_state(state['numpy'])
+    torch.set_rng_state(state['torch'])
+    if state['cuda'] and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state['cuda'])
+    if state['sampler'] is not None and shuffle_generator(loader) is not None:
+        shuffle_generator(loader).set_state(state['sampler'])
+    if state['loader'] is not None and loader.generator is not None:
+        if loader.persistent_workers:
+            loader.generator.manual_seed(state['loader_seed'])
+        else:
+            loader.generator.set_state(state['loader'])
+
+
+def atomic_save(obj, path):
+    # Write to a temporary file first so an interrupted run never leaves a partial checkpoint behind
+    tmp_path = f'{path}.tmp'
+    torch.save(obj, tmp_path)
+    os.replace(tmp_path, path)
+
+
+def load_resume_state(path):
+    """Training state saved after the last finished epoch, None if there is none."""
+    if not os.path.exists(path):
+        return None
+    state = torch.load(path, map_location='cpu', weights_only=False)
+    print(f'Resuming from {path} after epoch {state["epoch"]}')
+    return state
+
+
 def train_model(model, train_loader, val_loader, device, criterion, optimizer, lr_scheduler, num_epochs=25,
                 checkpoint_path='model.pth'):
     best_model = model.state_dict()
     best_epoch = None
     best_val_kappa = -1.0  # Initialize the best kappa score
-
-    for epoch in range(1, num_epochs + 1):
+    start_epoch = 1
+
+    # Continue an interrupted run after its last finished epoch
+    resume_path = resume_path_for(checkpoint_path)
+    state = load_resume_state(resume_path)
+    if state is not None:
+        model.load_state_dict(state['model'])
+        optimizer.load_state_dict(state['optimizer'])
+        lr_scheduler.load_state_dict(state['lr_scheduler'])
+        set_rng_state(state['rng'], train_loader)
+        best_val_kappa, best_epoch = state['best_val_kappa'], state['best_epoch']
+        start_epoch = state['epoch'] + 1
+
+    for epoch in range(start_epoch, num_epochs + 1):
         print(f'\nEpoch {epoch}/{num_epochs}')
-        running_loss = []
-        all_preds = []
-        all_labels = []
+        metrics = DeviceMetrics(num_classes, device)
 
         model.train()
 
         with tqdm(total=len(train_loader), desc=f'Training', unit=' batch', file=sys.stdout) as pbar:
-            for images, labels in train_loader:
+            for step, (images, labels) in enumerate(train_loader, 1):
                 if not isinstance(images, list):
                     images = images.to(device)  # single image case
                 else:
@@ -214,17 +288,21 @@ def train_model(model, train_loader, val_loader, device, criterion, optimizer, l
                 optimizer.step()
 
                 preds = torch.argmax(outputs, 1)
-                all_preds.extend(preds.cpu().numpy())
-                all_labels.extend(labels.cpu().numpy())
+                metrics.update(loss, preds, labels.long())
 
-                running_loss.append(loss.item())
-
-                pbar.set_postfix({'lr': f'{optimizer.param_groups[0]["lr"]:.1e}', 'Loss': f'{loss.item():.4f}'})
+                if step % sync_interval == 0:
+                    metrics.snapshot()
+                running_loss = metrics.poll()
+                if running_loss is not None:
+                    pbar.set_postfix({'lr': f'{optimizer.param_groups[0]["lr"]:.1e}', 'Loss': f'{running_loss:.4f}'})
                 pbar.update(1)
 
         lr_scheduler.step()
 
-        epoch_loss = sum(running_loss) / len(running_loss)
+        epoch_loss, confusion = metrics.flush()
+        all_labels, all_preds = np.divmod(
+            np.repeat(np.arange(num_classes * num_classes), confusion.ravel()), num_classes
+        )
 
         train_metrics = compute_metrics(all_preds, all_labels, per_class=True)
         kappa, accuracy, precision, recall = train_metrics[:4]
@@ -249,7 +327,19 @@ def train_model(model, train_loader, val_loader, device, criterion, optimizer, l
             best_model = model.state_dict()
             torch.save(best_model, checkpoint_path)
 
+        atomic_save({
+            'epoch': epoch,
+            'model': model.state_dict(),
+            'optimizer': optimizer.state_dict(),
+            'lr_scheduler': lr_scheduler.state_dict(),
+            'rng': rng_state(train_loader),
+            'best_val_kappa': best_val_kappa,
+            'best_epoch': best_epoch
+        }, resume_path)
+
     print(f'[Val] Best kappa: {best_val_kappa:.4f}, Epoch {best_epoch}')
+    if os.path.exists(resume_path):
+        os.remove(resume_path)
 
     return model
 
@@ -414,6 +504,35 @@ class BaggingEnsemble(nn.Module):
         return ensemble_output
 
 
+def seed_worker(worker_id):
+    # torch seeds each worker from the loader generator when the workers start, once per run with
+    # persistent_workers, but SLORandomPad and FundRandomRotate draw from `random` and CutOut from
+    # NumPy, so seed those from it too
+    worker_seed = torch.initial_seed() % 2 ** 32
+    np.random.seed(worker_seed)
+    random.seed(worker_seed)
+
+
+def make_generator(seed):
+    generator = torch.Generator()
+    if reproducible:
+        generator.manual_seed(seed)
+    else:
+        generator.seed()  # A new generator otherwise always starts from the same default seed
+    return generator
+
+
+def make_data_loader(dataset, shuffle, seed=42):
+    worker_kwargs = {}
+    if num_workers > 0:
+        worker_kwargs = dict(worker_init_fn=seed_worker, persistent_workers=persistent_workers,
+                             prefetch_factor=prefetch_factor)
+    # The order has its own generator, so the base seed draws of the loader's never shift it
+    sampler = RandomSampler(dataset, generator=make_generator(seed)) if shuffle else None
+    return DataLoader(dataset, batch_size=batch_size, sampler=sampler, num_workers=num_workers, pin_memory=True,
+                      generator=make_generator(seed + 1000), **worker_kwargs)
+
+
 if __name__ == '__main__':
     # Choose between 'single image' and 'dual images' pipeline
     # This will affect the model definition, dataset pipeline, training and evaluation
@@ -435,9 +554,9 @@ if __name__ == '__main__':
     test_dataset = RetinopathyDataset('./DeepDRiD/test.csv', './DeepDRiD/test/', transform_test, mode, test=True)
 
     # Create dataloaders
-    train_loader = DataLoader(train_dataset, batch_size=batch_size, shuffle=True)
-    val_loader = DataLoader(val_dataset, batch_size=batch_size, shuffle=False)
-    test_loader = DataLoader(test_dataset, batch_size=batch_size, shuffle=False)
+    train_loader = make_data_loader(train_dataset, shuffle=True, seed=42)
+    val_loader = make_data_loader(val_dataset, shuffle=False, seed=43)
+    test_loader = make_data_loader(test_dataset, shuffle=False, seed=44)
 
     # Define the weighted CrossEntropyLoss
     criterion = nn.CrossEntropyLoss()
@@ -448,6 +567,10 @@ if __name__ == '__main__':
     ensemble = ensemble.to(device)
     # Train each model in the ensemble
     for idx, model in enumerate(ensemble.models):
+        # A rerun skips members that finished, the interrupted one resumes from its last epoch
+        if os.path.exists(f'./model_{idx + 1}_checkpoint.pth'):
+            print(f"Model {idx + 1}/{num_models} already trained, skipping")
+            continue
         print(f"Training model {idx + 1}/{num_models}")
 
         # Load pretrained weights for the model
@@ -470,7 +593,7 @@ if __name__ == '__main__':
         )
 
         # Save the trained model's state
-        torch.save(model.state_dict(), f'./model_{idx + 1}_checkpoint.pth')
+        atomic_save(model.state_dict(), f'./model_{idx + 1}_checkpoint.pth')
 
     # Load the trained models into the ensemble
     for idx, model in enumerate(ensemble.models):
@@ -0,0 +1,105 @@
+# Benchmarks the per-step ImagePreprocessor chain against FusedPreprocessor on DeepDRiD images
+# and checks that both produce the same pixels within a tolerance. With --enhance-sizes it also
+# reports the speed vs pixel-difference tradeoff of resizing before enhancement.
+#
+# Example:
+#   python benchmark_preprocessing.py --num-images 50
+#   python benchmark_preprocessing.py --enhance-sizes 256 384 512
+
+import argparse
+import os
+import time
+
+import cv2
+import numpy as np
+import pandas as pd
+
+from aio import CONFIG, FusedPreprocessor, PreprocessingPipeline, decode_image, downscale_for_enhancement
+
+
+def load_images(ann_file, image_dir, num_images):
+    df = pd.read_csv(ann_file).head(num_images)
+    return [np.array(decode_image(os.path.join(image_dir, img_path))) for img_path in df['img_path']]
+
+
+def time_per_image(fn, images, repeats):
+    fn(images[0])  # Warm up buffers and OpenCV
+    start = time.perf_counter()
+    for _ in range(repeats):
+        for image in images:
+            fn(image)
+    return (time.perf_counter() - start) / (repeats * len(images))
+
+
+def benchmark(images, preprocessing_config, repeats=3):
+    chain = PreprocessingPipeline(preprocessing_config)
+    fused = FusedPreprocessor(preprocessing_config)
+
+    chain_time = time_per_image(lambda image: np.asarray(chain.process_image(image)), images, repeats)
+    fused_time = time_per_image(fused.process_array, images, repeats)
+
+    diffs = [np.abs(np.asarray(chain.process_image(image), dtype=np.int16) - fused.process_array(image))
+             for image in images]
+    return {
+        'chain_ms': chain_time * 1000,
+        'fused_ms': fused_time * 1000,
+        'speedup': chain_time / fused_time,
+        'mean_abs_diff': float(np.mean([diff.mean() for diff in diffs])),
+        'max_abs_diff': int(max(diff.max() for diff in diffs))
+    }
+
+
+def enhance_tradeoff(images, preprocessing_config, sizes, repeats=3):
+    """Compare enhance-then-resize (the reference) with resize-then-enhance at each size."""
+    fused = FusedPreprocessor(preprocessing_config)
+
+    def enhance_then_resize(image, size):
+        return cv2.resize(fused.process_array(image), (size, size), interpolation=cv2.INTER_AREA)
+
+    def resize_then_enhance(image, size):
+        resized, scale = downscale_for_enhancement(image, size)
+        return fused.process_array(resized, scale=scale)
+
+    rows = []
+    for size in sizes:
+        reference_time = time_per_image(lambda image: enhance_then_resize(image, size), images, repeats)
+        resized_time = time_per_image(lambda image: resize_then_enhance(image, size), images, repeats)
+        diffs = [np.abs(enhance_then_resize(image, size).astype(np.float64) - resize_then_enhance(image, size))
+                 for image in images]
+        mse = np.mean([np.mean(diff ** 2) for diff in diffs])
+        rows.append({
+            'size': size,
+            'enhance_first_ms': reference_time * 1000,
+            'resize_first_ms': resized_time * 1000,
+            'speedup': reference_time / resized_time,
+            'mean_abs_diff': float(np.mean([diff.mean() for diff in diffs])),
+            'psnr': float(10 * np.log10(255 ** 2 / mse)) if mse > 0 else float('inf')
+        })
+    return rows
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark fused vs per-step preprocessing')
+    parser.add_argument('--ann-file', default='./DeepDRiD/train.csv')
+    parser.add_argument('--image-dir', default='./DeepDRiD/train/')
+    parser.add_argument('--num-images', type=int, default=20)
+    parser.add_argument('--repeats', type=int, default=3)
+    parser.add_argument('--enhance-sizes', type=int, nargs='*', default=[],
+                        help='Working resolutions to evaluate for resize-before-enhance mode')
+    args = parser.parse_args()
+
+    images = load_images(args.ann_file, args.image_dir, args.num_images)
+    results = benchmark(images, CONFIG['preprocessing'], repeats=args.repeats)
+
+    print(f"Images: {len(images)} of size {images[0].shape[1]}x{images[0].shape[0]}")
+    print(f"Per-step chain: {results['chain_ms']:.2f} ms/image")
+    print(f"Fused:          {results['fused_ms']:.2f} ms/image")
+    print(f"Speedup:        {results['speedup']:.2f}x")
+    print(f"Pixel difference: mean {results['mean_abs_diff']:.3f}, max {results['max_abs_diff']}")
+
+    if args.enhance_sizes:
+        print('\nResize before enhance (reference: enhance at native resolution, then resize)')
+        print(f"{'size':>6} {'enhance first':>14} {'resize first':>13} {'speedup':>8} {'mean diff':>10} {'PSNR':>8}")
+        for row in enhance_tradeoff(images, CONFIG['preprocessing'], args.enhance_sizes, repeats=args.repeats):
+            print(f"{row['size']:>6} {row['enhance_first_ms']:>11.2f} ms {row['resize_first_ms']:>10.2f} ms "
+                  f"{row['speedup']:>7.2f}x {row['mean_abs_diff']:>10.3f} {row['psnr']:>5.1f} dB")
@@ -11,17 +11,28 @@ import torch
 import torch.nn as nn
 from PIL import Image
 from sklearn.metrics import cohen_kappa_score, precision_score, recall_score, accuracy_score
-from torch.utils.data import Dataset, DataLoader
+from torch.utils.data import Dataset, DataLoader, RandomSampler
 from torchvision import models, transforms
 from torchvision.transforms.functional import to_pil_image, adjust_gamma
 from tqdm import tqdm
 import torch.nn.functional as F
 from sklearn.ensemble import GradientBoostingClassifier
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from aio import DeviceMetrics  # noqa: E402
+
 # Hyper Parameters
 batch_size = 24
 num_classes = 5  # 5 DR levels
 learning_rate = 0.0001
 num_epochs = 20
+num_workers = min(8, os.cpu_count() or 1)  # DataLoader worker processes, 0 loads in the main process
+prefetch_factor = 2  # Batches loaded in advance by each worker
+persistent_workers = True  # Keep workers alive between epochs instead of re-forking them
+reproducible = True  # Draw shuffling and worker seeds from fixed-seed generators
+sync_interval = 50  # Training steps between host reads of the running loss
+use_amp = False  # Autocast forward passes to amp_dtype, losses and metrics stay float32
+amp_dtype = torch.bfloat16  # float16 needs CUDA and is trained with GradScaler loss scaling
 
 
 class RetinopathyDataset(Dataset):
@@ -183,22 +194,87 @@ transform_test = transforms.Compose([
 ])
 
 
+def resume_path_for(checkpoint_path):
+    stem, ext = os.path.splitext(checkpoint_path)
+    return f'{stem}_resume{ext}'
+
+
+def shuffle_generator(loader):
+    return getattr(loader.sampler, 'generator', None)
+
+
+def rng_state(loader):
+    return {
+        'python': random.getstate(),
+        'numpy': np.random.get_state(),
+        'torch': torch.get_rng_state(),
+        'cuda': torch.cuda.get_rng_state_all() if torch.cuda.is_available() else [],
+        'sampler': shuffle_generator(loader).get_state() if shuffle_generator(loader) is not None else None,
+        'loader': loader.generator.get_state() if loader.generator is not None else None,
+        'loader_seed': loader.generator.initial_seed() if loader.generator is not None else None
+    }
+
+
+def set_rng_state(state, loader):
+    # The sampler generator decides the shuffling order of every following epoch. The loader
+    # generator draws the workers' base seed whenever an iterator starts, which persistent
+    # workers do once per run, so a resumed run redraws that first seed
+    random.setstate(state['python'])
+    np.random.set_state(state['numpy'])
+    torch.set_rng_state(state['torch'])
+    if state['cuda'] and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state['cuda'])
+    if state['sampler'] is not None and shuffle_generator(loader) is not None:
+        shuffle_generator(loader).set_state(state['sampler'])
+    if state['loader'] is not None and loader.generator is not None:
+        if loader.persistent_workers:
+            loader.generator.manual_seed(state['loader_seed'])
+        else:
+            loader.generator.set_state(state['loader'])
+
+
+def atomic_save(obj, path):
+    # Write to a temporary file first so an interrupted run never leaves a partial checkpoint behind
+    tmp_path = f'{path}.tmp'
+    torch.save(obj, tmp_path)
+    os.replace(tmp_path, path)
+
+
+def load_resume_state(path):
+    """Training state saved after the last finished epoch, None if there is none."""
+    if not os.path.exists(path):
+        return None
+    state = torch.load(path, map_location='cpu', weights_only=False)
+    print(f'Resuming from {path} after epoch {state["epoch"]}')
+    return state
+
+
 def train_model(model, train_loader, val_loader, device, criterion, optimizer, lr_scheduler, num_epochs=25,
                 checkpoint_path='model.pth'):
     best_model = model.state_dict()
     best_epoch = None
     best_val_kappa = -1.0  # Initialize the best kappa score
-
-    for epoch in range(1, num_epochs + 1):
+    start_epoch = 1
+
+    # Continue an interrupted run after its last finished epoch
+    resume_path = resume_path_for(checkpoint_path)
+    state = load_resume_state(resume_path)
+    if state is not None:
+        model.load_state_dict(state['model'])
+        optimizer.load_state_dict(state['optimizer'])
+        lr_scheduler.load_state_dict(state['lr_scheduler'])
+        set_rng_state(state['rng'], train_loader)
+        best_val_kappa, best_epoch = state['best_val_kappa'], state['best_epoch']
+        start_epoch = state['epoch'] + 1
+
+    for epoch in range(start_epoch, num_epochs + 1):
         print(f'\nEpoch {epoch}/{num_epochs}')
-        running_loss = []
-        all_preds = []
-        all_labels = []
+        metrics = DeviceMetrics(num_classes, device)
 
         model.train()
 
         with tqdm(total=len(train_loader), desc=f'Training', unit=' batch', file=sys.stdout) as pbar:
-            for images, labels in train_loader:
+            for step, (images, labels) in enumerate(train_loader, 1):
                 if not isinstance(images, list):
                     images = images.to(device)  # single image case
                 else:
@@ -215,17 +291,21 @@ def train_model(model, train_loader, val_loader, device, criterion, optimizer, l
                 optimizer.step()
 
                 preds = torch.argmax(outputs, 1)
-                all_preds.extend(preds.cpu().numpy())
-                all_labels.extend(labels.cpu().numpy())
-
-                running_loss.append(loss.item())
+                metrics.update(loss, preds, labels.long())
 
-                pbar.set_postfix({'lr': f'{optimizer.param_groups[0]["lr"]:.1e}', 'Loss': f'{loss.item():.4f}'})
+                if step % sync_interval == 0:
+                    metrics.snapshot()
+                running_loss = metrics.poll()
+                if running_loss is not None:
+                    pbar.set_postfix({'lr': f'{optimizer.param_groups[0]["lr"]:.1e}', 'Loss': f'{running_loss:.4f}'})
                 pbar.update(1)
 
         lr_scheduler.step()
 
-        epoch_loss = sum(running_loss) / len(running_loss)
+        epoch_loss, confusion = metrics.flush()
+        all_labels, all_preds = np.divmod(
+            np.repeat(np.arange(num_classes * num_classes), confusion.ravel()), num_classes
+        )
 
         train_metrics = compute_metrics(all_preds, all_labels, per_class=True)
         kappa, accuracy, precision, recall = train_metrics[:4]
@@ -250,7 +330,19 @@ def train_model(model, train_loader, val_loader, device, criterion, optimizer, l
             best_model = model.state_dict()
             torch.save(best_model, checkpoint_path)
 
+        atomic_save({
+            'epoch': epoch,
+            'model': model.state_dict(),
+            'optimizer': optimizer.state_dict(),
+            'lr_scheduler': lr_scheduler.state_dict(),
+            'rng': rng_state(train_loader),
+            'best_val_kappa': best_val_kappa,
+            'best_epoch': best_epoch
+        }, resume_path)
+
     print(f'[Val] Best kappa: {best_val_kappa:.4f}, Epoch {best_epoch}')
+    if os.path.exists(resume_path):
+        os.remove(resume_path)
 
     return model
 
@@ -470,7 +562,15 @@ class BoostingEnsemble(nn.Module):
 
 
 
+def make_grad_scaler(enabled):
+    # torch.amp.GradScaler is new in torch 2.3, older releases only have the CUDA one
+    if hasattr(getattr(torch, 'amp', None), 'GradScaler'):
+        return torch.amp.GradScaler('cuda', enabled=enabled)
+    return torch.cuda.amp.GradScaler(enabled=enabled)
+
+
 def train_model_with_boosting(model, train_loader, val_loader, device, criterion, optimizer, lr_scheduler, num_epochs=25, checkpoint_path='model.pth'):
+    scaler = make_grad_scaler(use_amp and amp_dtype == torch.float16)
     best_model = model.state_dict()
     best_epoch = None
     best_val_kappa = -1.0
@@ -486,7 +586,22 @@ def train_model_with_boosting(model, train_loader, val_loader, device, criterion
     all_train_preds = []
     all_train_labels = []
 
-    for epoch in range(1, num_epochs + 1):
+    start_epoch = 1
+
+    # Continue an interrupted run after its last finished epoch
+    resume_path = resume_path_for(checkpoint_path)
+    state = load_resume_state(resume_path)
+    if state is not None:
+        model.load_state_dict(state['model'])
+        optimizer.load_state_dict(state['optimizer'])
+        lr_scheduler.load_state_dict(state['lr_scheduler'])
+        scaler.load_state_dict(state['scaler'])
+        set_rng_state(state['rng'], train_loader)
+        best_model, best_val_kappa, best_epoch = state['best_model'], state['best_val_kappa'], state['best_epoch']
+        training_history = state['training_history']
+        start_epoch = state['epoch'] + 1
+
+    for epoch in range(start_epoch, num_epochs + 1):
         print(f'\nEpoch {epoch}/{num_epochs}')
         running_loss = []
 
@@ -501,11 +616,14 @@ def train_model_with_boosting(model, train_loader, val_loader, device, criterion
 
                 optimizer.zero_grad()
 
-                outputs = model(images)
+                with torch.autocast(device.type, dtype=amp_dtype, enabled=use_amp):
+                    outputs = model(images)
+                outputs = outputs.float()
                 loss = criterion(outputs, labels.long())
 
-                loss.backward()
-                optimizer.step()
+                scaler.scale(loss).backward()
+                scaler.step(optimizer)
+                scaler.update()
 
                 preds = torch.argmax(outputs, 1)
                 epoch_train_preds.extend(preds.cpu().numpy())
@@ -532,7 +650,9 @@ def train_model_with_boosting(model, train_loader, val_loader, device, criterion
                 images = images.to(device)
                 labels = labels.to(device)
                 
-                outputs = model(images)
+                with torch.autocast(device.type, dtype=amp_dtype, enabled=use_amp):
+                    outputs = model(images)
+                outputs = outputs.float()
                 val_loss = criterion(outputs, labels.long())
                 
                 preds = torch.argmax(outputs, 1)
@@ -561,13 +681,30 @@ def train_model_with_boosting(model, train_loader, val_loader, device, criterion
             best_epoch = epoch
             best_model = copy.deepcopy(model.state_dict())
 
+        atomic_save({
+            'epoch': epoch,
+            'model': model.state_dict(),
+            'optimizer': optimizer.state_dict(),
+            'lr_scheduler': lr_scheduler.state_dict(),
+            'scaler': scaler.state_dict(),
+            'rng': rng_state(train_loader),
+            'best_model': best_model,
+            'best_val_kappa': best_val_kappa,
+            'best_epoch': best_epoch,
+            'training_history': training_history
+        }, resume_path)
+
     # Save the best model state
     torch.save(best_model, checkpoint_path)
+    if os.path.exists(resume_path):
+        os.remove(resume_path)
     print(f'Best model saved at epoch {best_epoch} with validation kappa: {best_val_kappa:.4f}')
     
     return model, training_history
 
-def train_and_extract_features(model, train_loader, val_loader, device, criterion, optimizer, num_epochs=25):
+def train_and_extract_features(model, train_loader, val_loader, device, criterion, optimizer, num_epochs=25,
+                               resume_path=None):
+    scaler = make_grad_scaler(use_amp and amp_dtype == torch.float16)
     model.train()
     all_train_features, all_train_labels = [], []
     
@@ -576,7 +713,21 @@ def train_and_extract_features(model, train_loader, val_loader, device, criterio
         n_estimators=100, learning_rate=0.1, max_depth=3, random_state=42
     )
 
-    for epoch in range(1, num_epochs + 1):
+    start_epoch = 1
+
+    # Continue an interrupted run after its last finished epoch, with the features collected so far
+    state = load_resume_state(resume_path) if resume_path else None
+    if state is not None:
+        model.load_state_dict(state['model'])
+        model.train(state['training'])  # Training continues in the mode the last epoch ended in
+        optimizer.load_state_dict(state['optimizer'])
+        scaler.load_state_dict(state['scaler'])
+        set_rng_state(state['rng'], train_loader)
+        all_train_features, all_train_labels = state['train_features'], state['train_labels']
+        val_features, val_labels = state['val_features'], state['val_labels']
+        start_epoch = state['epoch'] + 1
+
+    for epoch in range(start_epoch, num_epochs + 1):
         print(f'\nEpoch {epoch}/{num_epochs}')
         running_loss = []
         epoch_features = []
@@ -586,10 +737,13 @@ def train_and_extract_features(model, train_loader, val_loader, device, criterio
             for images, labels in train_loader:
                 images, labels = images.to(device), labels.to(device)
                 optimizer.zero_grad()
-                outputs = model(images)
+                with torch.autocast(device.type, dtype=amp_dtype, enabled=use_amp):
+                    outputs = model(images)
+                outputs = outputs.float()
                 loss = criterion(outputs, labels.long())
-                loss.backward()
-                optimizer.step()
+                scaler.scale(loss).backward()
+                scaler.step(optimizer)
+                scaler.update()
 
                 running_loss.append(loss.item())
                 pbar.update(1)
@@ -617,7 +771,9 @@ def train_and_extract_features(model, train_loader, val_loader, device, criterio
         with torch.no_grad():
             for images, labels in val_loader:
                 images, labels = images.to(device), labels.to(device)
-                outputs = model(images)
+                with torch.autocast(device.type, dtype=amp_dtype, enabled=use_amp):
+                    outputs = model(images)
+                outputs = outputs.float()
                 all_val_features.append(outputs.cpu().numpy())
                 all_val_labels.append(labels.cpu().numpy())
 
@@ -635,6 +791,23 @@ def train_and_extract_features(model, train_loader, val_loader, device, criterio
         val_accuracy = accuracy_score(val_labels.flatten(), val_preds)
         print(f'[Epoch {epoch}] Boosting Validation Accuracy: {val_accuracy:.4f}')
 
+        if resume_path:
+            atomic_save({
+                'epoch': epoch,
+                'model': model.state_dict(),
+                'training': model.training,
+                'optimizer': optimizer.state_dict(),
+                'scaler': scaler.state_dict(),
+                'rng': rng_state(train_loader),
+                'train_features': all_train_features,
+                'train_labels': all_train_labels,
+                'val_features': val_features,
+                'val_labels': val_labels
+            }, resume_path)
+
+    if resume_path and os.path.exists(resume_path):
+        os.remove(resume_path)
+
     # Return final features and labels
     final_train_features = np.concatenate(all_train_features)
     final_train_labels = np.concatenate(all_train_labels)
@@ -644,6 +817,35 @@ def train_and_extract_features(model, train_loader, val_loader, device, criterio
     return final_train_features, final_train_labels, final_val_features, final_val_labels
 
 
+def seed_worker(worker_id):
+    # torch seeds each worker from the loader generator when the workers start, once per run with
+    # persistent_workers, but SLORandomPad and FundRandomRotate draw from `random` and CutOut from
+    # NumPy, so seed those from it too
+    worker_seed = torch.initial_seed() % 2 ** 32
+    np.random.seed(worker_seed)
+    random.seed(worker_seed)
+
+
+def make_generator(seed):
+    generator = torch.Generator()
+    if reproducible:
+        generator.manual_seed(seed)
+    else:
+        generator.seed()  # A new generator otherwise always starts from the same default seed
+    return generator
+
+
+def make_data_loader(dataset, shuffle, seed=42):
+    worker_kwargs = {}
+    if num_workers > 0:
+        worker_kwargs = dict(worker_init_fn=seed_worker, persistent_workers=persistent_workers,
+                             prefetch_factor=prefetch_factor)
+    # The order has its own generator, so the base seed draws of the loader's never shift it
+    sampler = RandomSampler(dataset, generator=make_generator(seed)) if shuffle else None
+    return DataLoader(dataset, batch_size=batch_size, sampler=sampler, num_workers=num_workers, pin_memory=True,
+                      generator=make_generator(seed + 1000), **worker_kwargs)
+
+
 if __name__ == '__main__':
     # Choose between 'single image' and 'dual images' pipeline
     # This will affect the model definition, dataset pipeline, training and evaluation
@@ -668,9 +870,9 @@ if __name__ == '__main__':
     test_dataset = RetinopathyDataset('./DeepDRiD/test.csv', './DeepDRiD/test/', transform_test, mode, test=True)
 
     # Create dataloaders
-    train_loader = DataLoader(train_dataset, batch_size=batch_size, shuffle=True)
-    val_loader = DataLoader(val_dataset, batch_size=batch_size, shuffle=False)
-    test_loader = DataLoader(test_dataset, batch_size=batch_size, shuffle=False)
+    train_loader = make_data_loader(train_dataset, shuffle=True, seed=42)
+    val_loader = make_data_loader(val_dataset, shuffle=False, seed=43)
+    test_loader = make_data_loader(test_dataset, shuffle=False, seed=44)
 
     # Define the weighted CrossEntropyLoss
     criterion = nn.CrossEntropyLoss()
@@ -699,7 +901,8 @@ if __name__ == '__main__':
 
     # Train and evaluate the model with the training and validation set
     train_features, train_labels, val_features, val_labels = train_and_extract_features(
-        model, train_loader, val_loader, device, criterion, optimizer, num_epochs=num_epochs
+        model, train_loader, val_loader, device, criterion, optimizer, num_epochs=num_epochs,
+        resume_path='./resnet18Boosting2_resume.pth'
     )
     
 
@@ -15,6 +15,8 @@ from tqdm import tqdm
 batch_size = 16
 learning_rate = 0.001
 num_epochs = 20
+use_amp = False  # Autocast forward passes to amp_dtype, losses and metrics stay float32
+amp_dtype = torch.bfloat16  # float16 needs CUDA and is trained with GradScaler loss scaling
 num_classes = 5  # DR levels
 checkpoint_path = './best_model.pth'
 
@@ -89,8 +91,16 @@ class MyModel(nn.Module):
 class_weights = torch.tensor([1.0, 2.0, 1.5, 1.5, 2.0])  # Example weights for imbalance
 criterion = nn.CrossEntropyLoss(weight=class_weights)
 
+def make_grad_scaler(enabled):
+    # torch.amp.GradScaler is new in torch 2.3, older releases only have the CUDA one
+    if hasattr(getattr(torch, 'amp', None), 'GradScaler'):
+        return torch.amp.GradScaler('cuda', enabled=enabled)
+    return torch.cuda.amp.GradScaler(enabled=enabled)
+
+
 # Training Function
 def train_model(model, train_loader, val_loader, optimizer, scheduler, device, num_epochs):
+    scaler = make_grad_scaler(use_amp and amp_dtype == torch.float16)
     best_model_wts = copy.deepcopy(model.state_dict())
     best_kappa = -1.0
 
@@ -104,10 +114,13 @@ def train_model(model, train_loader, val_loader, optimizer, scheduler, device, n
             images, labels = images.to(device), labels.to(device)
             optimizer.zero_grad()
 
-            outputs = model(images)
+            with torch.autocast(device.type, dtype=amp_dtype, enabled=use_amp):
+                outputs = model(images)
+            outputs = outputs.float()
             loss = criterion(outputs, labels)
-            loss.backward()
-            optimizer.step()
+            scaler.scale(loss).backward()
+            scaler.step(optimizer)
+            scaler.update()
 
             running_loss += loss.item()
             all_preds.extend(torch.argmax(outputs, dim=1).cpu().numpy())
@@ -139,7 +152,9 @@ def evaluate_model(model, loader, device):
     with torch.no_grad():
         for images, labels in loader:
             images, labels = images.to(device), labels.to(device)
-            outputs = model(images)
+            with torch.autocast(device.type, dtype=amp_dtype, enabled=use_amp):
+                outputs = model(images)
+            outputs = outputs.float()
             preds = torch.argmax(outputs, dim=1)
             all_preds.extend(preds.cpu().numpy())
             all_labels.extend(labels.cpu().numpy())
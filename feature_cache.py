@@ -0,0 +1,230 @@
+# Caches the activations of a model's frozen leading layers in a memory-mapped feature store, so
+# head-only training runs the frozen backbone once instead of on every image in every epoch.
+#
+# split_frozen_prefix() finds the layers that can be cached: the longest leading run of layers
+# without trainable parameters, dropout or batch norm. FeatureStore.build() runs them once over
+# a dataset, for training over a fixed bank of augmented views of every image, and reuses the
+# store on later runs as long as the frozen weights, dataset and bank are unchanged.
+#
+# Example (see vgg2.py):
+#   prefix, suffix = split_frozen_prefix(model.backbone)
+#   train_store = FeatureStore.build('./feature_cache/train', prefix, train_dataset, device, bank_size=8)
+#   train_loader = DataLoader(CachedFeatureDataset(train_store, train_dataset), batch_size=24, shuffle=True)
+#   head = train_model(CachedHead(model, suffix), train_loader, ...)
+
+import hashlib
+import json
+import os
+import random
+
+import numpy as np
+import torch
+import torch.nn as nn
+from numpy.lib.format import open_memmap
+from torch.utils.data import DataLoader, Dataset
+from torchvision import models
+from tqdm import tqdm
+
+FEATURES_FILE = 'features.npy'
+INDEX_FILE = 'index.json'
+
+
+def layer_sequence(module):
+    """Layers of a module in execution order, for modules whose forward is a plain chain."""
+    if isinstance(module, nn.Sequential):
+        return [layer for child in module for layer in layer_sequence(child)]
+    if isinstance(module, models.VGG):
+        return layer_sequence(module.features) + [module.avgpool, nn.Flatten()] + layer_sequence(module.classifier)
+    if isinstance(module, models.ResNet):
+        layers = [module.conv1, module.bn1, module.relu, module.maxpool]
+        for stage in (module.layer1, module.layer2, module.layer3, module.layer4):
+            layers += layer_sequence(stage)
+        return layers + [module.avgpool, nn.Flatten(), module.fc]
+    return [module]
+
+
+def is_cacheable(layer):
+    # Trainable parameters change the output every step, dropout and batch norm depend on the mode
+    if any(param.requires_grad for param in layer.parameters()):
+        return False
+    return not any(isinstance(m, (nn.modules.dropout._DropoutNd, nn.modules.batchnorm._BatchNorm))
+                   for m in layer.modules())
+
+
+def split_frozen_prefix(module):
+    """(frozen prefix, trainable suffix) of a module, both Sequentials sharing its layers."""
+    layers = layer_sequence(module)
+    num_frozen = 0
+    while num_frozen < len(layers) and is_cacheable(layers[num_frozen]):
+        num_frozen += 1
+    if num_frozen == 0:
+        raise ValueError('The model has no frozen leading layers to cache')
+    if num_frozen == len(layers):
+        raise ValueError('The whole model is frozen, there is nothing to train')
+    return nn.Sequential(*layers[:num_frozen]), nn.Sequential(*layers[num_frozen:])
+
+
+class CachedHead(nn.Module):
+    """Trainable suffix of a model, fed with cached prefix activations.
+
+    Its layers are the model's own modules, so training it trains the model in place, and
+    state_dict() returns the state of the full model, so checkpoints load into the model.
+    """
+    def __init__(self, model, suffix):
+        super().__init__()
+        self.suffix = suffix
+        self._model = [model]  # Not registered as a submodule, the prefix is not part of training
+
+    def forward(self, x):
+        return self.suffix(x)
+
+    def state_dict(self, *args, **kwargs):
+        return self._model[0].state_dict(*args, **kwargs)
+
+    def load_state_dict(self, *args, **kwargs):
+        return self._model[0].load_state_dict(*args, **kwargs)
+
+
+class SeededView(Dataset):
+    """Dataset items with all RNGs seeded from (seed, view, index), so random augmentations repeat."""
+    def __init__(self, dataset, seed, view):
+        self.dataset = dataset
+        self.seed = seed
+        self.view = view
+
+    def __len__(self):
+        return len(self.dataset)
+
+    def __getitem__(self, idx):
+        item_seed = ((self.seed * 1000003 + self.view) * len(self.dataset) + idx) % 2 ** 32
+        random.seed(item_seed)
+        np.random.seed(item_seed)
+        torch.manual_seed(item_seed)
+        return self.dataset[idx]
+
+
+def describe_transform(transform):
+    """repr() of a transform with the default reprs, which hold memory addresses, replaced by its attributes."""
+    if isinstance(transform, (list, tuple)):
+        return '[' + ', '.join(describe_transform(t) for t in transform) + ']'
+    if hasattr(transform, 'transforms') or type(transform).__repr__ is object.__repr__:
+        fields = ', '.join(f'{name}={describe_transform(value)}' for name, value in vars(transform).items()
+                           if not name.startswith('_'))
+        return f'{type(transform).__qualname__}({fields})'
+    return repr(transform)
+
+
+def store_signature(prefix, dataset, bank_size, seed, dtype):
+    digest = hashlib.sha1(repr(prefix).encode())
+    for name, tensor in prefix.state_dict().items():
+        digest.update(name.encode())
+        digest.update(tensor.detach().cpu().contiguous().numpy().tobytes())
+    digest.update(json.dumps({
+        'ann_file': str(getattr(dataset, 'ann_file', '')),
+        'transform': describe_transform(getattr(dataset, 'transform', None)),
+        'num_samples': len(dataset),
+        'bank_size': bank_size,
+        'seed': seed,
+        'dtype': dtype
+    }, sort_keys=True).encode())
+    return digest.hexdigest()
+
+
+class FeatureStore:
+    """Memory-mapped prefix activations, row view * num_samples + index, plus the labels if any."""
+    def __init__(self, cache_dir):
+        with open(os.path.join(cache_dir, INDEX_FILE)) as f:
+            index = json.load(f)
+        self.features = np.load(os.path.join(cache_dir, FEATURES_FILE), mmap_mode='r')
+        self.labels = np.asarray(index['labels'], dtype=np.int64) if index['labels'] is not None else None
+        self.num_samples = index['num_samples']
+        self.bank_size = index['bank_size']
+        self.signature = index['signature']
+
+    @classmethod
+    def build(cls, cache_dir, prefix, dataset, device, bank_size=1, seed=0, batch_size=32, num_workers=0,
+              dtype='float32'):
+        """Store of prefix(dataset[i]) for bank_size seeded views of every item, reused when up to date.
+
+        Use bank_size=1 for deterministic inputs (val/test). The default float32 store gives the
+        head exactly the activations of the full model. dtype='float16' halves the store at the
+        cost of rounding every activation, about 4e-4 relative error, and is cast back to float32
+        when read.
+        """
+        signature = store_signature(prefix, dataset, bank_size, seed, dtype)
+        index_path = os.path.join(cache_dir, INDEX_FILE)
+        if os.path.exists(index_path):
+            with open(index_path) as f:
+                if json.load(f)['signature'] == signature:
+                    print(f'Using cached features from {os.path.abspath(cache_dir)}')
+                    return cls(cache_dir)
+            # The index is written last, so without it the features are never mistaken for complete
+            os.remove(index_path)
+        os.makedirs(cache_dir, exist_ok=True)
+
+        # Seeding every item must not change the RNG streams of the caller
+        rng_states = random.getstate(), np.random.get_state(), torch.get_rng_state()
+        try:
+            labels = cls._write_features(cache_dir, prefix.to(device).eval(), dataset, device, bank_size, seed,
+                                         batch_size, num_workers, dtype)
+        finally:
+            random.setstate(rng_states[0])
+            np.random.set_state(rng_states[1])
+            torch.set_rng_state(rng_states[2])
+
+        with open(index_path, 'w') as f:
+            json.dump({
+                'signature': signature,
+                'num_samples': len(dataset),
+                'bank_size': bank_size,
+                'labels': labels or None
+            }, f)
+        print(f'Cached {bank_size} x {len(dataset)} feature maps to {os.path.abspath(cache_dir)}')
+        return cls(cache_dir)
+
+    @staticmethod
+    def _write_features(cache_dir, prefix, dataset, device, bank_size, seed, batch_size, num_workers, dtype):
+        num_samples = len(dataset)
+        features = None
+        labels = []
+        with torch.no_grad():
+            for view in range(bank_size):
+                loader = DataLoader(SeededView(dataset, seed, view), batch_size=batch_size, shuffle=False,
+                                    num_workers=num_workers)
+                row = view * num_samples
+                for batch in tqdm(loader, desc=f'Caching features {view + 1}/{bank_size}', unit=' batch'):
+                    images, batch_labels = batch if isinstance(batch, (list, tuple)) else (batch, None)
+                    if isinstance(images, (list, tuple)):
+                        raise ValueError('Feature caching supports single image inputs only')
+                    outputs = prefix(images.to(device)).cpu().numpy()
+                    if features is None:
+                        features = open_memmap(os.path.join(cache_dir, FEATURES_FILE), mode='w+', dtype=dtype,
+                                               shape=(bank_size * num_samples, *outputs.shape[1:]))
+                    features[row:row + len(outputs)] = outputs
+                    row += len(outputs)
+                    if view == 0 and batch_labels is not None:
+                        labels.extend(batch_labels.tolist())
+        features.flush()
+        return labels
+
+
+class CachedFeatureDataset(Dataset):
+    """Cached activations as dataset items, with a random view of the augmentation bank per access.
+
+    `data` is the source dataset's sample list, which evaluate_model reads for image names.
+    """
+    def __init__(self, store, source=None):
+        self.store = store
+        self.data = getattr(source, 'data', None)
+
+    def __len__(self):
+        return self.store.num_samples
+
+    def __getitem__(self, idx):
+        view = random.randrange(self.store.bank_size) if self.store.bank_size > 1 else 0
+        # Copied out of the read-only memory map, cast to float32 for the head
+        features = torch.from_numpy(np.array(self.store.features[view * self.store.num_samples + idx],
+                                             dtype=np.float32))
+        if self.store.labels is None:
+            return features
+        return features, torch.tensor(self.store.labels[idx], dtype=torch.int64)
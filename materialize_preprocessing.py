@@ -0,0 +1,147 @@
+# Materializes preprocessed DeepDRiD images for a set of preprocessing configs with a process pool,
+# so training reads finished PNGs instead of preprocessing online. Each config is written to
+# <out-dir>/<config name>/<split>/ next to a rewritten <split>.csv; point
+# CONFIG['materialized_preprocessing'] in aio.py at <out-dir> to train from it.
+#
+# Images already on disk are skipped, so runs are incremental and resume where they stopped.
+# Configs sharing leading steps share their intermediate results, e.g. ben_graham is computed
+# once per image for every config that starts with it.
+#
+# Example:
+#   python materialize_preprocessing.py --ann-file ./DeepDRiD/train.csv --image-dir ./DeepDRiD/train/
+#   python materialize_preprocessing.py --ann-file ./DeepDRiD/val.csv --image-dir ./DeepDRiD/val/ \
+#       --configs ben_graham,circle_crop ben_graham,clahe none
+
+import argparse
+import itertools
+import os
+from multiprocessing import Pool
+
+import cv2
+import numpy as np
+import pandas as pd
+from PIL import Image
+from tqdm import tqdm
+
+from aio import (CONFIG, PREPROCESSING_STEPS, FusedPreprocessor, decode_image, enabled_preprocessing_steps,
+                 preprocessing_config_name)
+
+# Per-process state, set up once by init_worker
+_worker = {}
+
+
+def parse_config(spec):
+    steps = [] if spec == 'none' else spec.split(',')
+    unknown = set(steps) - set(PREPROCESSING_STEPS)
+    if unknown:
+        raise ValueError(f"Unknown preprocessing steps: {sorted(unknown)}")
+    return {step: step in steps for step in PREPROCESSING_STEPS}
+
+
+def all_configs():
+    return [dict(zip(PREPROCESSING_STEPS, flags))
+            for flags in itertools.product([False, True], repeat=len(PREPROCESSING_STEPS))]
+
+
+def build_step_tree(configs):
+    """Prefix tree over the ordered steps of each config, configs end at the node of their last step."""
+    root = {'children': {}, 'configs': []}
+    for config in configs:
+        node = root
+        for step in enabled_preprocessing_steps(config):
+            node = node['children'].setdefault(step, {'children': {}, 'configs': []})
+        node['configs'].append(preprocessing_config_name(config))
+    return root
+
+
+def output_path(config_name, rel_path):
+    return os.path.join(_worker['out_dir'], config_name, _worker['split'], rel_path)
+
+
+def has_pending(node, rel_path):
+    if any(not os.path.exists(output_path(name, rel_path)) for name in node['configs']):
+        return True
+    return any(has_pending(child, rel_path) for child in node['children'].values())
+
+
+def save_image(image, path):
+    size = _worker['size']
+    if size is not None and image.shape[:2] != (size, size):
+        image = cv2.resize(image, (size, size), interpolation=cv2.INTER_AREA)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    # Write to a temporary file first so an interrupted run never leaves a partial PNG behind
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    Image.fromarray(image).save(tmp_path, format='PNG', compress_level=1)
+    os.replace(tmp_path, path)
+
+
+def materialize_node(node, image, rel_path):
+    written = 0
+    for name in node['configs']:
+        path = output_path(name, rel_path)
+        if not os.path.exists(path):
+            save_image(image, path)
+            written += 1
+    for step, child in node['children'].items():
+        if has_pending(child, rel_path):
+            written += materialize_node(child, _worker['preprocessor'].process_array(image, steps=[step]), rel_path)
+    return written
+
+
+def init_worker(tree, out_dir, split, size):
+    cv2.setNumThreads(1)  # Parallelism comes from the process pool
+    _worker.update(tree=tree, out_dir=out_dir, split=split, size=size, preprocessor=FusedPreprocessor({}))
+
+
+def materialize_image(task):
+    src_path, rel_path = task
+    if not has_pending(_worker['tree'], rel_path):
+        return 0
+    return materialize_node(_worker['tree'], np.array(decode_image(src_path)), rel_path)
+
+
+def materialize(ann_file, image_dir, out_dir, configs, split=None, size=None, num_workers=None):
+    split = split or os.path.splitext(os.path.basename(ann_file))[0]
+    df = pd.read_csv(ann_file)
+    rel_paths = df['img_path'].str.replace(r'\.[^./]+$', '.png', regex=True)
+    tasks = list(zip(os.path.join(image_dir, '') + df['img_path'], rel_paths))
+    tree = build_step_tree(configs)
+
+    with Pool(num_workers, initializer=init_worker, initargs=(tree, out_dir, split, size)) as pool:
+        written = sum(tqdm(pool.imap_unordered(materialize_image, tasks, chunksize=8), total=len(tasks),
+                           desc=f'Materializing {split}', unit=' image'))
+
+    # The CSV is written last, so its presence marks a complete split
+    for config in configs:
+        config_dir = os.path.join(out_dir, preprocessing_config_name(config))
+        materialized_df = df.copy()
+        materialized_df['source_img_path'] = df['img_path']
+        materialized_df['img_path'] = rel_paths
+        materialized_df.to_csv(os.path.join(config_dir, f'{split}.csv'), index=False)
+
+    print(f'Wrote {written} images for {len(configs)} configs to {os.path.abspath(out_dir)}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Materialize preprocessed images for several configs')
+    parser.add_argument('--ann-file', required=True, help='Split CSV, e.g. ./DeepDRiD/train.csv')
+    parser.add_argument('--image-dir', required=True, help='Image directory of the split')
+    parser.add_argument('--out-dir', default=CONFIG['materialized_preprocessing']['materialized_dir'])
+    parser.add_argument('--split', default=None, help='Split name, defaults to the CSV file name')
+    parser.add_argument('--configs', nargs='*', default=None,
+                        help="Comma-separated steps per config, 'none' for no preprocessing. "
+                             "Defaults to CONFIG['preprocessing'].")
+    parser.add_argument('--all-configs', action='store_true', help='Materialize all 32 step combinations')
+    parser.add_argument('--size', type=int, default=None, help='Resize outputs to size x size')
+    parser.add_argument('--num-workers', type=int, default=None, help='Defaults to the number of CPUs')
+    args = parser.parse_args()
+
+    if args.all_configs:
+        configs = all_configs()
+    elif args.configs:
+        configs = [parse_config(spec) for spec in args.configs]
+    else:
+        configs = [CONFIG['preprocessing']]
+
+    materialize(args.ann_file, args.image_dir, args.out_dir, configs, split=args.split, size=args.size,
+                num_workers=args.num_workers)
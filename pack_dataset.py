@@ -0,0 +1,76 @@
+# Packs the DeepDRiD train/val/test splits into one memory-mapped uint8 array plus a label/ID index.
+# Point CONFIG['packed_dataset'] in aio.py at the output directory to train from it.
+#
+# Example:
+#   python pack_dataset.py --data-dir ./DeepDRiD --out-dir ./packed --size 512
+#   python pack_dataset.py --preprocess   # also bake CONFIG['preprocessing'] into the packed pixels
+
+import argparse
+import os
+
+import numpy as np
+import pandas as pd
+from PIL import Image
+from numpy.lib.format import open_memmap
+from tqdm import tqdm
+
+from aio import (CONFIG, PACKED_IMAGES_FILE, PACKED_INDEX_FILE, PreprocessingPipeline, decode_image,
+                 enabled_preprocessing_steps)
+
+SPLITS = ['train', 'val', 'test']
+
+
+def pack_dataset(data_dir, out_dir, size=512, preprocessing_config=None):
+    frames = []
+    for split in SPLITS:
+        df = pd.read_csv(os.path.join(data_dir, f'{split}.csv'))
+        df['split'] = split
+        df['image_dir'] = os.path.join(data_dir, split)
+        frames.append(df)
+    df = pd.concat(frames, ignore_index=True)
+
+    if 'patient_DR_Level' in df:
+        labels = df['patient_DR_Level'].fillna(-1).astype(np.int16).to_numpy()
+    else:
+        labels = np.full(len(df), -1, dtype=np.int16)
+
+    pipeline = PreprocessingPipeline(preprocessing_config, options=CONFIG['preprocessing_options']) if preprocessing_config else None
+
+    os.makedirs(out_dir, exist_ok=True)
+    images = open_memmap(os.path.join(out_dir, PACKED_IMAGES_FILE), mode='w+', dtype=np.uint8,
+                         shape=(len(df), size, size, 3))
+
+    for i, (image_dir, img_path) in enumerate(tqdm(zip(df['image_dir'], df['img_path']), total=len(df),
+                                                   desc='Packing', unit=' image')):
+        if pipeline:
+            # Preprocessing is tuned for full-resolution inputs, so only downscale afterwards
+            img = pipeline.process_image(decode_image(os.path.join(image_dir, img_path)))
+        else:
+            img = decode_image(os.path.join(image_dir, img_path), size=size)
+        images[i] = np.asarray(img.resize((size, size), Image.LANCZOS))
+    images.flush()
+    del images
+
+    np.savez(
+        os.path.join(out_dir, PACKED_INDEX_FILE),
+        split=df['split'].to_numpy(dtype=str),
+        image_id=df['image_id'].to_numpy(dtype=str),
+        img_path=df['img_path'].to_numpy(dtype=str),
+        label=labels,
+        size=np.int64(size),
+        preprocessing=np.str_(','.join(enabled_preprocessing_steps(preprocessing_config or {})))
+    )
+    print(f'Packed {len(df)} images of size {size}x{size} to {os.path.abspath(out_dir)}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Pack DeepDRiD splits into a memory-mapped array')
+    parser.add_argument('--data-dir', default='./DeepDRiD')
+    parser.add_argument('--out-dir', default=CONFIG['packed_dataset']['packed_dir'])
+    parser.add_argument('--size', type=int, default=512, help='Working resolution of the packed images')
+    parser.add_argument('--preprocess', action='store_true',
+                        help="Apply CONFIG['preprocessing'] before packing")
+    args = parser.parse_args()
+
+    pack_dataset(args.data_dir, args.out_dir, size=args.size,
+                 preprocessing_config=CONFIG['preprocessing'] if args.preprocess else None)
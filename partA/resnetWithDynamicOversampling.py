@@ -9,12 +9,13 @@ import torch
 import torch.nn as nn
 from PIL import Image
 from sklearn.metrics import cohen_kappa_score, precision_score, recall_score, accuracy_score
-from torch.utils.data import Dataset, DataLoader, WeightedRandomSampler
+from torch.utils.data import Dataset, DataLoader
 from torchvision import models, transforms
 from torchvision.transforms.functional import to_pil_image
 from tqdm import tqdm
-from collections import Counter
-from sklearn.utils.class_weight import compute_class_weight
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from aio import DynamicOversampler  # noqa: E402
 
 
 # Hyper Parameters
@@ -47,6 +48,11 @@ class RetinopathyDataset(Dataset):
         else:
             return self.get_item_dual(index)
 
+    @property
+    def labels(self):
+        # Read straight from the annotations, no image is decoded
+        return np.array([file_info['dr_level'] for file_info in self.data], dtype=np.int64)
+
     # 1. single image
     def load_data(self):
         df = pd.read_csv(self.ann_file)
@@ -408,19 +414,9 @@ if __name__ == '__main__':
     val_dataset = RetinopathyDataset('./DeepDRiD/val.csv', './DeepDRiD/val/', transform_test, mode)
     test_dataset = RetinopathyDataset('./DeepDRiD/test.csv', './DeepDRiD/test/', transform_test, mode, test=True)
 
-    # trying Dynamic Oversampling
-    class_counts = Counter([label for _, label in train_dataset])
-    total_samples = sum(class_counts.values())
-    labels = [int(label) for _, label in train_dataset]
-
-    # Compute class weights
-    unique_classes = np.unique(labels)
-    class_weights = compute_class_weight('balanced', classes=unique_classes, y=labels)
-    class_weights = {cls: weight for cls, weight in zip(unique_classes, class_weights)}
-
-    # Generate sample weights
-    sample_weights = [class_weights.get(int(label), 1.0) for _, label in train_dataset]
-    sampler = WeightedRandomSampler(weights=sample_weights, num_samples=len(sample_weights), replacement=True)
+    # trying Dynamic Oversampling, weights come from the annotations instead of iterating the images
+    sampler = DynamicOversampler(train_dataset.labels)
+    class_weights = sampler.class_weights
     
     # Create dataloaders
     train_loader = DataLoader(train_dataset, batch_size=batch_size, sampler=sampler)
@@ -430,7 +426,7 @@ if __name__ == '__main__':
     # Define the weighted CrossEntropyLoss
     # criterion = nn.CrossEntropyLoss()
     device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
-    class_weights_tensor = torch.tensor([class_weights[cls] for cls in range(num_classes)], dtype=torch.float32).to(device)
+    class_weights_tensor = torch.tensor(class_weights, dtype=torch.float32).to(device)
     criterion = nn.CrossEntropyLoss(weight=class_weights_tensor)
 
     # Use GPU device is possible
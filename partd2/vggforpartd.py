@@ -17,11 +17,15 @@ import cv2
 from PIL import Image, ImageEnhance
 from torchvision.transforms.functional import to_tensor
 
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from aio import retina_bbox  # noqa: E402
+
 # Hyper Parameters
 batch_size = 24
 num_classes = 5  # 5 DR levels
 learning_rate = 0.0001
 num_epochs = 20
+retina_crop = False  # Crop every image to the bounding box of the retina before resizing
 
 
 class RetinopathyDataset(Dataset):
@@ -138,6 +142,17 @@ class CutOut(object):
 
 
 
+# One CLAHE object per process, creating it costs more than applying it to a small image
+_clahe = None
+
+
+def get_clahe():
+    global _clahe
+    if _clahe is None:
+        _clahe = cv2.createCLAHE(clipLimit=2.0, tileGridSize=(8, 8))
+    return _clahe
+
+
 class CLAHETransform:
     """Apply CLAHE (Contrast Limited Adaptive Histogram Equalization) to images."""
     def __call__(self, img):
@@ -146,13 +161,11 @@ class CLAHETransform:
         if len(img_np.shape) == 3:  # RGB Image
             lab = cv2.cvtColor(img_np, cv2.COLOR_RGB2LAB)
             l, a, b = cv2.split(lab)
-            clahe = cv2.createCLAHE(clipLimit=2.0, tileGridSize=(8, 8))
-            cl = clahe.apply(l)
+            cl = get_clahe().apply(l)
             lab = cv2.merge((cl, a, b))
             img_np = cv2.cvtColor(lab, cv2.COLOR_LAB2RGB)
         else:  # Grayscale Image
-            clahe = cv2.createCLAHE(clipLimit=2.0, tileGridSize=(8, 8))
-            img_np = clahe.apply(img_np)
+            img_np = get_clahe().apply(img_np)
         return Image.fromarray(img_np)
 
 class GaussianBlurTransform:
@@ -164,12 +177,21 @@ class GaussianBlurTransform:
 
 class SharpeningTransform:
     """Sharpen the image."""
+    kernel = np.array([[0, -1, 0], [-1, 5, -1], [0, -1, 0]])  # Sharpening kernel
+
     def __call__(self, img):
         img_np = np.array(img)
-        kernel = np.array([[0, -1, 0], [-1, 5, -1], [0, -1, 0]])  # Sharpening kernel
-        sharpened = cv2.filter2D(img_np, -1, kernel)
+        sharpened = cv2.filter2D(img_np, -1, self.kernel)
         return Image.fromarray(sharpened)
 
+class RetinaCropTransform:
+    """Crop to the bounding box of the retina (aio.retina_bbox), so the black border is not resized into the input."""
+    def __init__(self, threshold=10):
+        self.threshold = threshold
+
+    def __call__(self, img):
+        return img.crop(tuple(int(v) for v in retina_bbox(np.asarray(img), self.threshold)))
+
 class CircleCropTransform:
     """Perform Ben Graham's circle cropping."""
     def __call__(self, img):
@@ -221,6 +243,7 @@ class FundRandomRotate:
 
 
 transform_train = transforms.Compose([
+    *([RetinaCropTransform()] if retina_crop else []),
     transforms.Resize((256, 256)),
     transforms.RandomCrop((210, 210)),
     SLORandomPad((224, 224)),
@@ -238,6 +261,7 @@ transform_train = transforms.Compose([
 ])
 
 transform_test = transforms.Compose([
+    *([RetinaCropTransform()] if retina_crop else []),
     transforms.Resize((224, 224)),
     transforms.ToTensor(),
     transforms.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225])
@@ -0,0 +1,38 @@
+import os
+import sys
+
+import torch
+import torch.nn as nn
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from aio import CheckpointManager  # noqa: E402
+
+
+def save_resume(checkpoint_path, run_config):
+    model = nn.Linear(4, 2)
+    optimizer = torch.optim.SGD(model.parameters(), lr=0.1)
+    checkpoints = CheckpointManager(checkpoint_path)
+    checkpoints.save_resume(model, optimizer, epoch=3, batch_index=5, run_config=run_config)
+    checkpoints.wait()
+    return model
+
+
+def test_resume_state_is_loaded_for_the_same_run_config(tmp_path):
+    run_config = {'batch_size': 24, 'data_loader': {'num_workers': 2}}
+    model = save_resume(str(tmp_path / 'model.pth'), run_config)
+
+    state = CheckpointManager(str(tmp_path / 'model.pth')).load_resume(dict(run_config))
+    assert state['epoch'] == 3 and state['batch_index'] == 5
+    for name, tensor in model.state_dict().items():
+        assert torch.equal(state['model_state_dict'][name], tensor)
+
+
+def test_resume_state_of_another_run_config_is_ignored(tmp_path):
+    save_resume(str(tmp_path / 'model.pth'), {'batch_size': 24})
+
+    checkpoints = CheckpointManager(str(tmp_path / 'model.pth'))
+    assert checkpoints.load_resume({'batch_size': 32}) is None
+    assert checkpoints.best_metric is None and checkpoints.best_model_state is None
+    assert CheckpointManager(str(tmp_path / 'model.pth')).load_resume(None) is None
+    assert checkpoints.load_resume({'batch_size': 24}) is not None
@@ -0,0 +1,88 @@
+import os
+import sys
+import warnings
+
+import numpy as np
+import pytest
+from sklearn.metrics import accuracy_score, cohen_kappa_score, precision_score, recall_score
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from aio import ConfusionMatrix  # noqa: E402
+
+NUM_CLASSES = 5
+
+
+def sklearn_metrics(preds, labels):
+    with warnings.catch_warnings():
+        # Single-class sets make kappa undefined, both sides must then return nan
+        warnings.simplefilter('ignore')
+        return (
+            cohen_kappa_score(labels, preds, weights='quadratic'),
+            accuracy_score(labels, preds),
+            precision_score(labels, preds, average='weighted', zero_division=0),
+            recall_score(labels, preds, average='weighted', zero_division=0),
+            precision_score(labels, preds, average=None, zero_division=0),
+            recall_score(labels, preds, average=None, zero_division=0),
+        )
+
+
+def assert_same_metrics(got, expected):
+    assert len(got) == len(expected)
+    for got_value, expected_value in zip(got, expected):
+        np.testing.assert_array_equal(np.asarray(got_value), np.asarray(expected_value))
+
+
+def random_set(rng, classes, size, accuracy=0.6):
+    labels = rng.choice(classes, size)
+    noise = rng.choice(NUM_CLASSES, size)
+    preds = np.where(rng.random(size) < accuracy, labels, noise)
+    return preds, labels
+
+
+@pytest.mark.parametrize('seed', range(200))
+def test_random_sets_match_sklearn(seed):
+    rng = np.random.default_rng(seed)
+    preds, labels = random_set(rng, np.arange(NUM_CLASSES), int(rng.integers(1, 300)))
+    matrix = ConfusionMatrix(NUM_CLASSES).update(preds, labels)
+    assert_same_metrics(matrix.metrics(per_class=True), sklearn_metrics(preds, labels))
+
+
+@pytest.mark.parametrize('seed', range(100))
+def test_missing_classes_match_sklearn(seed):
+    rng = np.random.default_rng(1000 + seed)
+    classes = rng.choice(NUM_CLASSES, size=int(rng.integers(2, NUM_CLASSES)), replace=False)
+    labels = rng.choice(classes, int(rng.integers(1, 200)))
+    # Predictions drawn from the same subset, so some classes appear in neither
+    preds = rng.choice(classes, len(labels))
+    matrix = ConfusionMatrix(NUM_CLASSES).update(preds, labels)
+    assert_same_metrics(matrix.metrics(per_class=True), sklearn_metrics(preds, labels))
+
+
+@pytest.mark.parametrize('label', range(NUM_CLASSES))
+def test_single_class_matches_sklearn(label):
+    labels = np.full(17, label)
+    for preds in (labels.copy(), np.random.default_rng(label).choice(NUM_CLASSES, 17)):
+        matrix = ConfusionMatrix(NUM_CLASSES).update(preds, labels)
+        assert_same_metrics(matrix.metrics(per_class=True), sklearn_metrics(preds, labels))
+
+
+@pytest.mark.parametrize('seed', range(100))
+def test_split_and_merged_batches_match_sklearn(seed):
+    rng = np.random.default_rng(2000 + seed)
+    preds, labels = random_set(rng, np.arange(NUM_CLASSES), int(rng.integers(2, 300)))
+    cuts = np.sort(rng.integers(0, len(labels) + 1, size=3))
+    bounds = [0, *cuts, len(labels)]
+
+    # Batches streamed into one matrix, and per-batch matrices merged as if from other processes
+    streamed = ConfusionMatrix(NUM_CLASSES)
+    merged = ConfusionMatrix(NUM_CLASSES)
+    for start, end in zip(bounds[:-1], bounds[1:]):
+        streamed.update(preds[start:end], labels[start:end])
+        merged.merge(ConfusionMatrix.from_labels(preds[start:end], labels[start:end], NUM_CLASSES))
+
+    expected = sklearn_metrics(preds, labels)
+    np.testing.assert_array_equal(streamed.counts, merged.counts)
+    assert_same_metrics(streamed.metrics(per_class=True), expected)
+    assert_same_metrics(merged.metrics(per_class=True), expected)
+    assert_same_metrics(merged.metrics(), expected[:4])
@@ -0,0 +1,67 @@
+import os
+import subprocess
+import sys
+import textwrap
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+BUILD_SCRIPT = textwrap.dedent('''
+    import sys
+
+    import torch
+    import torch.nn as nn
+    from torch.utils.data import Dataset
+    from torchvision import transforms
+
+    from feature_cache import FeatureStore
+
+
+    class AddNoise:
+        # No __repr__, like the custom transforms of the training scripts
+        def __init__(self, scale):
+            self.scale = scale
+
+        def __call__(self, img):
+            return img + self.scale * torch.randn_like(img)
+
+
+    class ImageDataset(Dataset):
+        def __init__(self):
+            self.images = torch.arange(6 * 3 * 8 * 8, dtype=torch.float32).reshape(6, 3, 8, 8) / 1000
+            self.transform = transforms.Compose([AddNoise(0.1), transforms.Normalize([0.5] * 3, [0.2] * 3)])
+
+        def __len__(self):
+            return len(self.images)
+
+        def __getitem__(self, idx):
+            return self.transform(self.images[idx]), idx % 5
+
+
+    torch.manual_seed(0)
+    prefix = nn.Sequential(nn.Conv2d(3, 4, 3), nn.ReLU())
+    for param in prefix.parameters():
+        param.requires_grad = False
+    store = FeatureStore.build(sys.argv[1], prefix, ImageDataset(), 'cpu', bank_size=2)
+    print(store.signature)
+''')
+
+
+def build_store(script, cache_dir):
+    result = subprocess.run([sys.executable, str(script), str(cache_dir)], capture_output=True, text=True,
+                            cwd=REPO_DIR, env={**os.environ, 'PYTHONPATH': REPO_DIR}, check=True)
+    return result.stdout
+
+
+def test_store_is_reused_by_a_later_process(tmp_path):
+    script = tmp_path / 'build_store.py'
+    script.write_text(BUILD_SCRIPT)
+    cache_dir = tmp_path / 'cache'
+
+    first = build_store(script, cache_dir)
+    features_mtime = os.path.getmtime(cache_dir / 'features.npy')
+    second = build_store(script, cache_dir)
+
+    assert 'Cached 2 x 6 feature maps' in first
+    assert 'Using cached features' in second
+    assert first.splitlines()[-1] == second.splitlines()[-1]
+    assert os.path.getmtime(cache_dir / 'features.npy') == features_mtime
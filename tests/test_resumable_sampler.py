@@ -0,0 +1,67 @@
+import os
+import sys
+
+import pytest
+import torch
+from torch.utils.data import Dataset, RandomSampler, get_worker_info
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from aio import ResumableDataLoader, ResumableSampler  # noqa: E402
+
+NUM_SAMPLES = 24
+BATCH_SIZE = 4
+NUM_EPOCHS = 3
+
+
+class IndexDataset(Dataset):
+    """Sample index and the base seed of the worker loading it."""
+    def __len__(self):
+        return NUM_SAMPLES
+
+    def __getitem__(self, idx):
+        worker = get_worker_info()
+        base_seed = torch.initial_seed() - worker.id if worker is not None else -1
+        return idx, base_seed
+
+
+def make_loader(num_workers, persistent_workers, seed):
+    generator = torch.Generator().manual_seed(seed)
+    dataset = IndexDataset()
+    sampler = ResumableSampler(RandomSampler(dataset, generator=generator), generator)
+    return ResumableDataLoader(dataset, batch_size=BATCH_SIZE, sampler=sampler, generator=generator,
+                               num_workers=num_workers, persistent_workers=persistent_workers)
+
+
+def batches(loader, epochs, stop=None):
+    """(indices, base seeds) of every batch, for epochs and up to batch `stop` of the last one."""
+    seen = []
+    for epoch in epochs:
+        for batch_idx, (indices, seeds) in enumerate(loader):
+            if epoch == epochs[-1] and batch_idx == stop:
+                break
+            seen.append((indices.tolist(), seeds.tolist()))
+    return seen
+
+
+@pytest.mark.parametrize('num_workers, persistent_workers', [(0, False), (2, False), (2, True)])
+@pytest.mark.parametrize('epoch, batch', [(2, 0), (2, 3), (3, 1)])
+def test_interrupted_run_matches_uninterrupted(num_workers, persistent_workers, epoch, batch):
+    epochs = list(range(1, NUM_EPOCHS + 1))
+    expected = batches(make_loader(num_workers, persistent_workers, seed=0), epochs)
+
+    # Killed before batch `batch` of `epoch`, at the epoch end before it for batch 0
+    loader = make_loader(num_workers, persistent_workers, seed=0)
+    if batch:
+        seen = batches(loader, epochs[:epoch], stop=batch)
+    else:
+        seen = batches(loader, epochs[:epoch - 1])
+    state = loader.sampler.state_dict(batch * BATCH_SIZE)
+    del loader
+
+    # A new process seeds its generator differently, the resume state replaces it
+    resumed = make_loader(num_workers, persistent_workers, seed=1)
+    resumed.sampler.load_state_dict(state)
+    seen += batches(resumed, epochs[epoch - 1:])
+
+    assert seen == expected
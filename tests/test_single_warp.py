@@ -0,0 +1,49 @@
+import os
+import random
+import sys
+
+import numpy as np
+import pytest
+import torch
+from PIL import Image
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from aio import SingleWarpAugmentation  # noqa: E402
+
+VALUE = 180
+
+
+def flat_image(width, height):
+    return Image.fromarray(np.full((height, width, 3), VALUE, dtype=np.uint8))
+
+
+@pytest.mark.parametrize('size', [(300, 300), (200, 200), (128, 128), (300, 200), (1100, 700)])
+@pytest.mark.parametrize('seed', range(20))
+def test_flat_image_stays_flat_without_rotation(size, seed):
+    random.seed(seed)
+    torch.manual_seed(seed)
+    augment = SingleWarpAugmentation(rotate_prob=0)
+    output = np.asarray(augment(flat_image(*size)))
+
+    # Exactly the crop window is image, the padding around it stays black
+    covered = (output != 0).all(axis=2)
+    assert covered.sum() == augment.crop_size ** 2
+    rows, cols = np.nonzero(covered)
+    assert rows.max() - rows.min() + 1 == augment.crop_size
+    assert cols.max() - cols.min() + 1 == augment.crop_size
+    assert (output[covered] == VALUE).all()
+    assert (output[~covered] == 0).all()
+
+
+@pytest.mark.parametrize('size', [(300, 300), (200, 200), (128, 128)])
+@pytest.mark.parametrize('seed', range(20))
+def test_flat_image_stays_flat_with_rotation(size, seed):
+    random.seed(seed)
+    torch.manual_seed(seed)
+    augment = SingleWarpAugmentation(rotate_prob=1)
+    output = np.asarray(augment(flat_image(*size)))
+
+    # The rotated window has hard edges, pixels are either image or black padding and fill
+    assert np.isin(output, [0, VALUE]).all()
+    assert (output != 0).all(axis=2).sum() > augment.crop_size ** 2 // 2
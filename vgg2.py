@@ -14,12 +14,19 @@ from torchvision import models, transforms
 from torchvision.transforms.functional import to_pil_image
 from tqdm import tqdm
 
+from feature_cache import CachedFeatureDataset, CachedHead, FeatureStore, split_frozen_prefix
+
 # Hyper Parameters
 batch_size = 24
 num_classes = 5  # 5 DR levels
 learning_rate = 0.0001
 num_epochs = 10
 
+# Run the frozen VGG16 layers once and train the unfrozen ones from their cached activations
+use_feature_cache = False
+feature_cache_dir = './feature_cache/vgg2'
+augmentation_bank_size = 8  # Cached augmented views of every training image
+
 
 class RetinopathyDataset(Dataset):
     def __init__(self, ann_file, image_dir, transform=None, mode='single', test=False):
@@ -415,6 +422,18 @@ if __name__ == '__main__':
     optimizer = torch.optim.Adam(params=model.parameters(), lr=learning_rate)
     lr_scheduler = torch.optim.lr_scheduler.StepLR(optimizer, step_size=10, gamma=0.1)
 
+    if use_feature_cache:
+        # Training epochs sample one of the cached augmented views instead of a fresh augmentation
+        prefix, suffix = split_frozen_prefix(model.backbone)
+        train_store = FeatureStore.build(os.path.join(feature_cache_dir, 'train'), prefix, train_dataset, device,
+                                         bank_size=augmentation_bank_size)
+        val_store = FeatureStore.build(os.path.join(feature_cache_dir, 'val'), prefix, val_dataset, device)
+        test_store = FeatureStore.build(os.path.join(feature_cache_dir, 'test'), prefix, test_dataset, device)
+        train_loader = DataLoader(CachedFeatureDataset(train_store, train_dataset), batch_size=batch_size, shuffle=True)
+        val_loader = DataLoader(CachedFeatureDataset(val_store, val_dataset), batch_size=batch_size, shuffle=False)
+        test_loader = DataLoader(CachedFeatureDataset(test_store, test_dataset), batch_size=batch_size, shuffle=False)
+        model = CachedHead(model, suffix)
+
     # Train and evaluate the model with the training and validation set
     model = train_model(
         model, train_loader, val_loader, device, criterion, optimizer,